@@ -1,17 +1,20 @@
-from recModule import Database
+from recModule import Storage
 import sys
 
 if __name__ == "__main__":
     print("check connection with the database......",end="")
-    status, code, msg = Database.checkDatabase()
+    status, code, msg = Storage.getStorage().checkDatabase()
     if status:
         print("Success!")
         print("Tables already exists")
         sys.exit()
-    if code != "f405":
+    if code == "hash_mode":
+        print("Hash mode mismatch: %s" % msg)
+        sys.exit()
+    if code != "no_tables":
         print("Connect to database failed: %s" % msg)
         print("Please check your config")
         sys.exit()
     print("Creating tables......",end="")
-    Database.createTables()
+    Storage.getStorage().createTables()
     print("Success!")
\ No newline at end of file
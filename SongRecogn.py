@@ -1,36 +1,74 @@
-from recModule import add_audio, add_dir, recognize
-from recModule import Console, Database
-import sys, time, os
+from recModule import add_audio, add_dir, recognize, recognize_dir, recognize_stream, compile_index
+from recModule import Console, Storage, Server
+import sys, time, os, argparse
 
 description = "A song recognize application using Shazam algorithm"
 console_methods = {
     "add-audio":"add a audio to the database",
     "add-dir":"add audio from a directory",
     "recognize":"recognzie a audio sample from file",
+    "recognize-dir":"recognize every audio file in a directory",
+    "recognize-stream":"recognize a live stream, \"-\" reads mono s16le PCM from stdin",
+    "compile-index":"compile fingerprints into a memory-mapped index for recognize",
     "help":"show help",
     "quit":"Quit"
 }
 console_methods_usage = {
     "add-audio":"add-audio song/song.mp3",
     "add-dir":"add-audio song",
-    "recognize":"recognzie sample/song_01.mp3"
+    "recognize":"recognzie sample/song_01.mp3",
+    "recognize-dir":"recognize-dir sample (non-interactive: SongRecogn.py recognize-dir sample --jobs 8 --out results.jsonl)",
+    "recognize-stream":"recognize-stream -",
+    "compile-index":"compile-index index"
 }
 console_methods_factory = {
     "add-audio":add_audio,
     "add-dir":add_dir,
-    "recognize":recognize
+    "recognize":recognize,
+    "recognize-dir":recognize_dir,
+    "recognize-stream":recognize_stream,
+    "compile-index":compile_index
 }
 
+def runCommand(argv):
+    """非交互模式, 执行命令行参数给出的一条命令"""
+    parser = argparse.ArgumentParser(description=description)
+    subparsers = parser.add_subparsers(dest="method", required=True)
+    for method, factory in console_methods_factory.items():
+        subparser = subparsers.add_parser(method, help=console_methods[method])
+        subparser.add_argument("path")
+        if factory is recognize_dir:
+            subparser.add_argument("--jobs", type=int, default=None, help="worker processes, default recConfig.max_process_num")
+            subparser.add_argument("--out", default=None, help="write one JSON line per clip to this file")
+    subparser = subparsers.add_parser("serve", help="start the asyncio recognition service (POST /recognize, GET /metrics)")
+    subparser.add_argument("--host", default=None)
+    subparser.add_argument("--port", type=int, default=None)
+    subparser.add_argument("--unix", default=None, help="listen on a unix socket instead of tcp")
+    subparser.add_argument("--jobs", type=int, default=None, help="fingerprint processes, default recConfig.max_process_num")
+    args = parser.parse_args(argv)
+    if args.method == "serve":
+        Server.serve(args.host, args.port, args.unix, args.jobs)
+    elif args.method == "recognize-dir":
+        recognize_dir(args.path, args.jobs, args.out)
+    else:
+        console_methods_factory[args.method](args.path)
+
 if __name__ == "__main__":
     Console.log("Check connection with the database......",end="")
-    status,code,msg = Database.checkDatabase()
+    status,code,msg = Storage.getStorage().checkDatabase()
     if not status:
         Console.log("Connect to database failed: %s" % msg)
         Console.log("Please check config or database.")
         sys.exit()
     Console.log("Success!")
+
+    if len(sys.argv) > 1:
+        runCommand(sys.argv[1:])
+        sys.exit()
+
     time.sleep(1)
-    os.system("cls")
+    if sys.stdout.isatty():
+        os.system("cls" if os.name == "nt" else "clear")
 
     Console.log("-" * 20)
     Console.log(description)
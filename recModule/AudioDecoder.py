@@ -1,8 +1,7 @@
-from recModule import Console
-from pydub import AudioSegment
 from recModule.Config import recConfig
+from recModule import Metrics
 from typing import Union, Tuple, Any, List, Generator
-import os, hashlib
+import os, re, hashlib, subprocess
 import numpy as np
 
 
@@ -32,64 +31,207 @@ def generateFilehash(filepath: "str", blocksize = 2 ** 16) -> str:
             m.update(buf)
     return m.hexdigest().upper()
 
-def encodeAudio(filepath: "str", dir="temp"):
-    """调整音频的路径和格式.\n
+# ffmpeg 输出的声道布局名称中不含声道数的部分, 如 "5.1(side)" 等数字布局按各部分之和计算
+CHANNEL_LAYOUTS = {"mono": 1, "stereo": 2, "downmix": 2, "quad": 4, "hexagonal": 6, "octagonal": 8, "hexadecagonal": 16}
 
-    使用ffmpeg编码音频.
+def probeChannels(filepath: "str") -> int:
+    """使用ffmpeg获取音频的声道数\n
+
+    不输出文件运行 ffmpeg -i, 从其打印的第一个音频流信息(如 "Audio: mp3, 44100 Hz, stereo, fltp")中解析声道布局,
+    不需要额外安装 ffprobe
+
+    Parameters
+    ----------
+    filepath : str
+        音频文件路径
+
+    Returns
+    -------
+    int
+        第一个音频流的声道数
+
+    Raises
+    ------
+    ValueError
+        文件中没有音频流或无法识别声道布局
+    """
+    # 没有指定输出文件时 ffmpeg 以非零状态退出, 不检查返回值
+    err = subprocess.run(["ffmpeg", "-hide_banner", "-nostdin", "-i", filepath],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE).stderr.decode("utf-8", "replace")
+    match = re.search(r"Stream #\S+.*?: Audio: [^,]+, \d+ Hz, ([^,]+)", err)
+    if match is None:
+        raise ValueError("No audio stream found in %s" % filepath)
+    layout = match.group(1).strip()
+    if layout in CHANNEL_LAYOUTS:
+        return CHANNEL_LAYOUTS[layout]
+    numeric = re.match(r"(\d+) channels|(\d+)\.(\d+)", layout)
+    if numeric is None:
+        raise ValueError("Unknown channel layout %r in %s" % (layout, filepath))
+    if numeric.group(1):
+        return int(numeric.group(1))
+    return int(numeric.group(2)) + int(numeric.group(3))
+
+def ffmpegCommand(filepath: "str", frame_rate=recConfig.audio_frame_rate, channel_strategy=recConfig.channel_strategy, channels=None):
+    """生成将音频解码为原始 PCM(s16le) 并输出到标准输出的ffmpeg命令
 
     Parameters
     ----------
     filepath : str
         音频文件路径
-    dir : str, optional
-        额外的中间路径, by default "temp"
+    frame_rate : int, optional
+        目标采样频率, by default recConfig.audio_frame_rate
+    channel_strategy : str, optional
+        声道处理方式, by default recConfig.channel_strategy
+    channels : int, optional
+        channel_strategy 为 "all" 时输出的声道数, by default None
 
     Returns
     -------
-    Union[Tuple[int, int], Tuple[Any, List[None]]]
-        返回采样频率和通道数
+    List[str]
+        ffmpeg命令参数
     """
-    dir = os.path.realpath(dir)
-    Console.log("Encode Audio with ffmpeg......", end = "")
-    if not os.path.exists(dir):
-        os.makedirs(dir)
-    path = os.path.join(dir, "temp" + generateFilehash(filepath)[:6:] + recConfig.extened_name)
-    os.system(" ".join(["ffmpeg", "-loglevel", "quiet", "-i", "\"%s\"" % filepath, "-y", "-acodec", "mp3", "-ar", str(recConfig.audio_frame_rate), "\"%s\"" % path]))
-    return read(path)
-
-def read(filepath) -> Union[Tuple[int, int], Tuple[Any, List[None]]]:
+    command = ["ffmpeg", "-loglevel", "quiet", "-nostdin", "-i", filepath, "-f", "s16le", "-acodec", "pcm_s16le", "-ar", str(frame_rate)]
+    if channel_strategy == "mono_mix":
+        command += ["-ac", "1"]
+    elif channel_strategy == "left_only":
+        command += ["-af", "pan=mono|c0=c0"]
+    elif channel_strategy == "all":
+        command += ["-ac", str(channels)]
+    else:
+        raise ValueError("Unknown channel strategy: %s" % channel_strategy)
+    return command + ["-"]
+
+def read(filepath, channel_strategy=None) -> Union[Tuple[int, List[Any]], Tuple[int, int]]:
     """通过文件路径读取音频文件以获取 frame_rate 和 channels.\n
 
-    Call encodeAudio Function to set all audio file frame rate with a default value and same extensions.
+    ffmpeg 直接把音频解码并重采样为 recConfig.audio_frame_rate 的原始 PCM, 通过管道读入 NumPy 数组,
+    不再生成临时文件.
 
     Parameters
     ----------
     filepath : str
         音频文件路径
+    channel_strategy : str, optional
+        声道处理方式, None 时使用 recConfig.channel_strategy, by default None
 
     Returns
     -------
-    Union[Tuple[int, int], Tuple[Any, List[None]]]
-        返回采样频率和通道数
+    Union[Tuple[int, List[Any]], Tuple[int, int]]
+        返回采样频率和各声道的 int16 数据, 读取失败时返回 (0, 0)
     """
+    channel_strategy = channel_strategy or recConfig.channel_strategy
     try:
-        filename, exten = os.path.splitext(filepath)
-        audiofile = AudioSegment.from_file(filepath)
-        if audiofile.frame_rate != recConfig.audio_frame_rate or exten != recConfig.extened_name:
-            return encodeAudio(filename)
-        data = np.fromstring(audiofile.raw_data, dtype=np.int16)
-        channels = []
-        for channel in range(audiofile.channels):
-            channels.append(data[channel::audiofile.channels])
-    except:
+        channels = probeChannels(filepath) if channel_strategy == "all" else 1
+        with Metrics.timer("decode"):
+            proc = subprocess.run(ffmpegCommand(filepath, recConfig.audio_frame_rate, channel_strategy, channels),
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+            data = np.frombuffer(proc.stdout, dtype=np.int16)
+        Metrics.count("decoded_bytes", data.nbytes)
+        if data.size == 0:
+            return 0, 0
+    except (OSError, ValueError, subprocess.CalledProcessError):
         return 0, 0
 
-    return audiofile.frame_rate, channels
+    data = data[:data.size - data.size % channels].reshape(-1, channels)
+    return recConfig.audio_frame_rate, [data[:, channel] for channel in range(channels)]
 
-def readDir(filesdir) -> Generator[Tuple[Union[bytes, str], Any, str], Any, None]:
-    """Encrypt the corresponding files in the directory.\n
+def readStream(filepath, chunk_seconds=recConfig.stream_chunk_seconds, channel_strategy=None) -> Generator[List[Any], Any, None]:
+    """分块读取音频文件\n
 
-    文件目录中具有受支持扩展名的文件进行sha256加密。
+    ffmpeg 解码输出的 PCM 通过管道按 chunk_seconds 分块读取, 内存占用与文件长度无关
+
+    Parameters
+    ----------
+    filepath : str
+        音频文件路径
+    chunk_seconds : int, optional
+        每块音频的长度(秒), by default recConfig.stream_chunk_seconds
+    channel_strategy : str, optional
+        声道处理方式, None 时使用 recConfig.channel_strategy, by default None
+
+    Yields
+    ------
+    List[NDArray]
+        当前块各声道的 int16 数据, 采样频率为 recConfig.audio_frame_rate
+    """
+    channel_strategy = channel_strategy or recConfig.channel_strategy
+    channels = probeChannels(filepath) if channel_strategy == "all" else 1
+    chunk_bytes = int(chunk_seconds * recConfig.audio_frame_rate) * channels * 2
+    proc = subprocess.Popen(ffmpegCommand(filepath, recConfig.audio_frame_rate, channel_strategy, channels),
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            buf = proc.stdout.read(chunk_bytes)
+            if not buf:
+                break
+            data = np.frombuffer(buf, dtype=np.int16)
+            data = data[:data.size - data.size % channels].reshape(-1, channels)
+            yield [data[:, channel] for channel in range(channels)]
+    finally:
+        proc.stdout.close()
+        proc.kill()
+        proc.wait()
+
+def readPCM(fh, channels=1, chunk_seconds=recConfig.live_block_seconds) -> Generator[List[Any], Any, None]:
+    """从二进制流中分块读取 s16le 格式的 PCM 数据, 例如标准输入或套接字
+
+    Parameters
+    ----------
+    fh : BinaryIO
+        PCM 数据流, 采样频率为 recConfig.audio_frame_rate, 多声道时交错存放
+    channels : int, optional
+        声道数, by default 1
+    chunk_seconds : float, optional
+        每块音频的长度(秒), by default recConfig.live_block_seconds
+
+    Yields
+    ------
+    List[NDArray]
+        当前块各声道的 int16 数据
+    """
+    frame_bytes = channels * 2
+    chunk_bytes = int(chunk_seconds * recConfig.audio_frame_rate) * frame_bytes
+    rest = b""
+    while True:
+        buf = fh.read(chunk_bytes)
+        if not buf:
+            break
+        buf = rest + buf
+        # 不完整的采样帧留到下一块
+        cut = len(buf) - len(buf) % frame_bytes
+        rest = buf[cut:]
+        data = np.frombuffer(buf[:cut], dtype=np.int16).reshape(-1, channels)
+        yield [data[:, channel] for channel in range(channels)]
+
+def mixChannels(channels, strategy=recConfig.channel_strategy):
+    """按照声道处理方式合并声道
+
+    Parameters
+    ----------
+    channels : List[NDArray]
+        各声道的采样数据(来自read)
+    strategy : str, optional
+        "mono_mix" 取各声道平均值, "left_only" 只保留第一个声道, "all" 保留全部声道, by default recConfig.channel_strategy
+
+    Returns
+    -------
+    List[NDArray]
+        处理后的声道列表
+    """
+    if strategy == "all" or len(channels) <= 1:
+        return channels
+    if strategy == "left_only":
+        return channels[:1]
+    if strategy == "mono_mix":
+        mixed = np.zeros(len(channels[0]), dtype=np.float32)
+        for channel in channels:
+            mixed += channel
+        mixed /= len(channels)
+        return [mixed]
+    raise ValueError("Unknown channel strategy: %s" % strategy)
+
+def listDir(filesdir) -> Generator[str, Any, None]:
+    """列出目录中具有受支持扩展名的文件, recConfig.search_subdir 为 True 时包含子目录
 
     Parameters
     ----------
@@ -98,22 +240,40 @@ def readDir(filesdir) -> Generator[Tuple[Union[bytes, str], Any, str], Any, None
 
     Returns
     -------
-    Generator[Tuple[Union[bytes, str], Any, str], Any, None]
-        生成器 (filepath, filename, filehash)
+    Generator[str, Any, None]
+        生成器 filepath
     """
     for root, dirs, files in os.walk(filesdir):
         # 遍历文件
         for file in files:
-            filename, ext = os.path.splitext(os.path.split(file)[1])
-            if ext in recConfig.support_audio:
-                try:
-                    fh = generateFilehash(os.path.join(root, file))
-                except:
-                    continue
-                yield(os.path.join(root, file), filename, fh)
+            if os.path.splitext(file)[1] in recConfig.support_audio:
+                yield os.path.join(root, file)
         if not recConfig.search_subdir:
             break
 
+def readDir(filesdir) -> Generator[Tuple[Union[bytes, str], Any, str], Any, None]:
+    """Encrypt the corresponding files in the directory.\n
+
+    文件目录中具有受支持扩展名的文件进行sha256加密。
+
+    Parameters
+    ----------
+    filesdir : str
+        文件目录
+
+    Returns
+    -------
+    Generator[Tuple[Union[bytes, str], Any, str], Any, None]
+        生成器 (filepath, filename, filehash)
+    """
+    for filepath in listDir(filesdir):
+        filename = os.path.splitext(os.path.split(filepath)[1])[0]
+        try:
+            fh = generateFilehash(filepath)
+        except:
+            continue
+        yield(filepath, filename, fh)
+
 
 if __name__ == '__main__':
     s = generateFilehash("C:/Users/mdw/Desktop/demo/liangyu.mp3")
@@ -0,0 +1,217 @@
+from recModule.Config import recConfig
+from recModule.Fingerprint import FPconfig
+from collections import OrderedDict
+import os, json, hashlib, threading, tempfile
+import numpy as np
+
+# 每个缓存项除 postings 数据以外的大致内存占用(哈希 key、数组对象和 OrderedDict 节点), 单位字节
+ENTRY_OVERHEAD = 250
+# 每条 (song_id, offset) posting 的内存占用, 两个 int64
+POSTING_SIZE = 16
+
+class HashCache(object):
+    """哈希到 postings 的 LRU 缓存\n
+
+    postings 为形状 (n, 2) 的 int64 数组, 每行为 (song_id, offset), 数据库中不存在的哈希缓存为空数组,
+    总占用超过 max_bytes 时淘汰最久未使用的项
+
+    Parameters
+    ----------
+    max_bytes : int
+        内存预算(字节), 0 为不缓存
+    """
+
+    def __init__(self, max_bytes=recConfig.hash_cache_size):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _size(postings):
+        return ENTRY_OVERHEAD + POSTING_SIZE * len(postings)
+
+    def getMany(self, hashes, out):
+        """查询一批哈希, 命中的 postings 写入 out
+
+        Parameters
+        ----------
+        hashes : List
+            待查询的哈希
+        out : Dict
+            哈希到 postings 的映射
+
+        Returns
+        -------
+        List
+            未命中的哈希
+        """
+        misses = []
+        with self.lock:
+            for fingerprint in hashes:
+                postings = self.entries.get(fingerprint)
+                if postings is None:
+                    misses.append(fingerprint)
+                else:
+                    self.entries.move_to_end(fingerprint)
+                    out[fingerprint] = postings
+            self.hits += len(hashes) - len(misses)
+            self.misses += len(misses)
+        return misses
+
+    def putMany(self, postings):
+        """写入哈希到 postings 数组(见 Storage.groupPostings)的映射, 超出内存预算时按 LRU 淘汰"""
+        if self.max_bytes <= 0:
+            return
+        with self.lock:
+            for fingerprint, value in postings.items():
+                old = self.entries.pop(fingerprint, None)
+                if old is not None:
+                    self.bytes -= self._size(old)
+                self.entries[fingerprint] = value
+                self.bytes += self._size(value)
+            while self.bytes > self.max_bytes and self.entries:
+                _, old = self.entries.popitem(last=False)
+                self.bytes -= self._size(old)
+                self.evictions += 1
+
+    def invalidate(self, hashes):
+        """删除一批哈希的缓存, 这些哈希有新的指纹写入"""
+        with self.lock:
+            if not self.entries:
+                return
+            for fingerprint in hashes:
+                old = self.entries.pop(fingerprint, None)
+                if old is not None:
+                    self.bytes -= self._size(old)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """缓存统计
+
+        Returns
+        -------
+        Dict[str, int]
+            hits、misses、evictions、entries 和 bytes
+        """
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.bytes}
+
+
+_cache = None
+_pid = None
+
+def getCache():
+    """获取当前进程的哈希缓存\n
+
+    fork 出的子进程沿用父进程已缓存的内容, 只重新创建锁
+
+    Returns
+    -------
+    HashCache
+        哈希缓存
+    """
+    global _cache, _pid
+    if _cache is None:
+        _cache = HashCache(recConfig.hash_cache_size)
+    elif _pid != os.getpid():
+        _cache.lock = threading.Lock()
+    _pid = os.getpid()
+    return _cache
+
+
+def fingerprintParamsKey(channel_strategy=None):
+    """生成指纹时使用的全部参数的摘要\n
+
+    包括 FPconfig 的所有参数、采样频率和声道处理方式, 任意一项改变后摘要随之改变, 旧的指纹缓存不再命中
+
+    Parameters
+    ----------
+    channel_strategy : str, optional
+        声道处理方式, None 时使用 recConfig.channel_strategy, by default None
+
+    Returns
+    -------
+    str
+        16 位十六进制摘要
+    """
+    params = {name: value for name, value in vars(FPconfig).items() if not name.startswith("_")}
+    params["audio_frame_rate"] = recConfig.audio_frame_rate
+    params["channel_strategy"] = channel_strategy or recConfig.channel_strategy
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+def _fingerprintPath(filehash, channel_strategy):
+    return os.path.join(recConfig.fingerprint_cache_dir, fingerprintParamsKey(channel_strategy), filehash + ".npz")
+
+def loadFingerprints(filehash, channel_strategy=None):
+    """从磁盘缓存读取指纹
+
+    Parameters
+    ----------
+    filehash : str
+        音频文件的 sha256
+    channel_strategy : str, optional
+        声道处理方式, None 时使用 recConfig.channel_strategy, by default None
+
+    Returns
+    -------
+    Optional[NDArray]
+        以 ("hash", "offset") 为字段的结构化数组, 未启用缓存或未命中时返回 None
+    """
+    if not recConfig.fingerprint_cache_dir or not filehash:
+        return None
+    path = _fingerprintPath(filehash, channel_strategy)
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as data:
+            hashes, offsets = data["hash"], data["offset"]
+    except (OSError, ValueError, KeyError):
+        # 损坏的缓存文件当作未命中
+        return None
+    if hashes.dtype.kind == "S":
+        hashes = hashes.astype("U64")
+    # 保存时已经排序去重
+    fingerprints = np.empty(len(hashes), dtype=[("hash", hashes.dtype), ("offset", np.int64)])
+    fingerprints["hash"] = hashes
+    fingerprints["offset"] = offsets
+    return fingerprints
+
+def saveFingerprints(filehash, fingerprints, channel_strategy=None):
+    """将指纹写入磁盘缓存, 先写临时文件再替换, 多个进程同时写入同一个文件也不会损坏
+
+    Parameters
+    ----------
+    filehash : str
+        音频文件的 sha256
+    fingerprints : NDArray
+        以 ("hash", "offset") 为字段的结构化数组
+    channel_strategy : str, optional
+        声道处理方式, None 时使用 recConfig.channel_strategy, by default None
+    """
+    if not recConfig.fingerprint_cache_dir or not filehash:
+        return
+    path = _fingerprintPath(filehash, channel_strategy)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    hashes = fingerprints["hash"]
+    # sha256 模式下按 ASCII 字节保存, 只占 unicode 字符串的四分之一
+    if hashes.dtype.kind == "U":
+        hashes = hashes.astype("S64")
+    fd, tmp = tempfile.mkstemp(suffix=".npz", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            np.savez_compressed(fh, hash=hashes, offset=fingerprints["offset"])
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
@@ -1,6 +1,8 @@
 from recModule.Config import recConfig
-from recModule import Model
-import time, gc
+from recModule import Model, Storage, Index, Cache, AudioDecoder, Metrics
+from concurrent.futures import ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
+import sys, time, gc, json
+import numpy as np
 
 def log(*msg, end = "\n"):
     """Console output message"""
@@ -12,15 +14,34 @@ def log(*msg, end = "\n"):
 
 def commandWrapper(func):
     if not recConfig.enable_console_msg:
-        return lambda :func
+        return func
     def wrapper(*args, **kwargs):
         print("--->")
-        func(*args, **kwargs)
+        result = func(*args, **kwargs)
         print("<---\n")
+        return result
     return wrapper
 
+def reportMetrics(command, before, **fields):
+    """开启 recConfig.metrics_enabled 时输出本次命令各阶段的耗时和计数(一行 JSON), 并写入 Prometheus 文本文件
+
+    Parameters
+    ----------
+    command : str
+        命令名, 写入 JSON 日志
+    before : Dict
+        命令开始时的 Metrics.snapshot()
+    """
+    if not Metrics.enabled():
+        return
+    data = Metrics.diff(Metrics.snapshot(), before)
+    log("Stage time: " + ", ".join("%s %.3f sec" % (name, item["seconds"]) for name, item in data["timers"].items()))
+    log(Metrics.logLine(data, command=command, **fields))
+    Metrics.writePrometheus()
+
 @commandWrapper
 def addAudio(filepath):
+    before = Metrics.snapshot()
     log("Check Song hashtag")
     song = Model.Audio.initFromFile(filepath)
     log("-Adding audio %s to the database-" % song.filename)
@@ -29,20 +50,32 @@ def addAudio(filepath):
         return
     song.getId(new=True)
     log("Get song id success: song id",song.id)
-    log("Start read song data", end="......")
-    song.read()
-    log("Success")
+    if recConfig.stream_fingerprint:
+        log("Start stream fingerprints into database", end="......")
+        t1 = time.time()
+        total = song.startInsertFingerprintsStream()
+        t2 = time.time()
+        if total is None:
+            log("Read song data fail")
+            return
+        log("Success! (Time cost: %.2f sec, total number: %s ) " % (t2 - t1, total))
+        log("Add Song Success!")
+        reportMetrics("add-audio", before, file=filepath)
+        return
     log("Start get fingerprints", end="......")
     t1 = time.time()
-    song.getFingerprints()
+    if not song.prepareFingerprints(recConfig.channel_strategy):
+        log("Read song data fail")
+        return
     t2 = time.time()
-    log("Success! (Time cost: %d sec, total number: %s ) " % (t2 - t1, len(song.fingerprints)))
+    log("Success! (Time cost: %.2f sec, total number: %s ) " % (t2 - t1, len(song.fingerprints)))
     log("Start insert fingerprints", end="......")
     t1 = time.time()
     song.startInsertFingerprints()
     t2 = time.time()
-    log("Insert fingerprints into database success (Time cost: %d sec)" % (t2 - t1))
+    log("Insert fingerprints into database success (Time cost: %.2f sec)" % (t2 - t1))
     log("Add Song Success!")
+    reportMetrics("add-audio", before, file=filepath)
 
 @commandWrapper
 def addAudioFromDir(dir):
@@ -57,62 +90,173 @@ def addAudioFromDir(dir):
     for song in songs:
         song.getId(new=True)
         print("Song Id: %s, song name: %s" % (song.id, song.name))
-    log("Start generate fingerprints.")
-    for i in range(0, songs_num, recConfig.max_process_num):
-        tempnum = i + recConfig.max_process_num if i + recConfig.max_process_num <= songs_num else songs_num
-        log("Processing %d/%d" % (tempnum, songs_num), end="......")
-        t1 = time.time()
-        total_threads = []
-        running_threads = []
-        st = 0
-        while st < len(total_threads):
-            if len(running_threads) < recConfig.max_process_num:
-                total_threads[st].start()
-                running_threads.append(total_threads[st])
-                st += 1
-                time.sleep(0.2)
-                continue
-            for t in running_threads:
-                if not t.is_alive():
-                    running_threads.remove(t)
-        for t in total_threads:
-            t.join()
-        t2 = time.time()
-        log("Finish! (Time cost: %d)" % (t2-t1))
-
-        for song in songs[i:i+recConfig.max_process_num:]:
-            log("Start insert fingerprints for %s" % song.name, end="......")
+    log("Start generate fingerprints with %d processes." % recConfig.max_process_num)
+    # 大量导入时先删除指纹索引, 全部导入后一次性重建
+    defer_index = songs_num >= recConfig.defer_index_threshold
+    if defer_index:
+        log("Drop fingerprint index before bulk loading")
+        Storage.getStorage().dropFingerprintIndex()
+    try:
+        # 子进程负责解码和生成指纹, 主进程作为唯一的写入者插入数据库
+        # 同时提交的任务数有上限, 防止写入慢于生成时结果堆积在内存中
+        pending = {}
+        queued = iter(songs)
+        finished = 0
+        t0 = time.time()
+        with ProcessPoolExecutor(max_workers=recConfig.max_process_num) as executor:
+            while True:
+                for song in queued:
+                    pending[executor.submit(Model.fingerprintFile, song.filepath, recConfig.channel_strategy, song.filehash)] = song
+                    if len(pending) >= 2 * recConfig.max_process_num:
+                        break
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    song = pending.pop(future)
+                    finished += 1
+                    song.fingerprints = future.result()
+                    if song.fingerprints is None:
+                        log("Processing %d/%d: read %s fail" % (finished, songs_num, song.filename))
+                        continue
+                    log("Processing %d/%d: insert %d fingerprints for %s" % (finished, songs_num, len(song.fingerprints), song.name), end="......")
+                    t1 = time.time()
+                    song.startInsertFingerprints()
+                    song.cleanup()
+                    t2 = time.time()
+                    log("Success (Time cost: %.2f sec)" % (t2 - t1))
+                gc.collect()
+    finally:
+        if defer_index:
+            log("Rebuild fingerprint index", end="......")
             t1 = time.time()
-            song.startInsertFingerprints()
-            song.cleanup()
-            t2 = time.time()
-            log("Insert fingerprints into database success (Time cost: %d sec)" % (t2 - t1))
-
-        gc.collect()
+            Storage.getStorage().createFingerprintIndex()
+            log("Success (Time cost: %.2f sec)" % (time.time() - t1))
 
+    log("Finish! (Time cost: %.2f sec)" % (time.time() - t0))
     log("all audio have been added")
 
+@commandWrapper
+def compileIndex(path):
+    log("Compile fingerprint index to %s" % path, end="......")
+    t1 = time.time()
+    try:
+        postings, keys = Index.compileIndex(Storage.getStorage(), path)
+    except ValueError as err:
+        log("Fail: %s" % err)
+        return
+    log("Success! (Time cost: %.2f sec, %d fingerprints, %d distinct hashes)" % (time.time() - t1, postings, keys))
+    # 本次会话之后的识别直接使用新索引
+    recConfig.index_path = path
+
 @commandWrapper
 def recognizeAudio(filepath):
+    before = Metrics.snapshot()
     song = Model.Audio.initFromFile(filepath)
     log("Recognizing %s" % song.filename)
-    log("Start read audio data......", end="")
-    song.read()
-    log("Success")
-
     log("Start get fingerprints......", end="")
-    song.getFingerprints()
+    if not song.prepareFingerprints(recConfig.channel_strategy):
+        log("Read audio data fail")
+        return
     log("Success (Total number: %s)" % len(song.fingerprints))
 
     log("Recognize......")
     t1 = time.time()
-    result = song.recognize_s()
+    if recConfig.early_exit:
+        result = song.recognizeEarly()
+    else:
+        result = song.recognize_s()
     t2 = time.time()
     if result["count"] == 0:
         log("Can not find any song fit this audio")
+        reportMetrics("recognize", before, file=filepath, name=None)
         return
-    log("Most Possible: %s (fingerprints match: %s), using %d sec" % (result["name"], result["count"], t2 - t1))
+    log("Most Possible: %s (fingerprints match: %s), using %.3f sec" % (result["name"], result["count"], t2 - t1))
+    log("Position: %.2f sec, coverage: %.2f, confidence: %.2f, %d/%d fingerprints queried" % (result["position"], result["coverage"], result["confidence"], result["hashes"], len(song.fingerprints)))
+    stats = Cache.getCache().stats()
+    log("Hash cache: %d hits, %d misses, %d entries" % (stats["hits"], stats["misses"], stats["entries"]))
+    reportMetrics("recognize", before, file=filepath, name=result["name"])
+
+
+@commandWrapper
+def recognizeDir(dir, jobs=None, out=None):
+    """批量识别目录中的音频文件
+
+    每个工作进程只建立一次数据库连接, 解码、生成指纹和查询都在工作进程中完成,
+    每个文件的结果作为一行 JSON 写入 out, 最后输出吞吐量、延迟分位数和各阶段耗时
 
+    Parameters
+    ----------
+    dir : str
+        音频文件目录
+    jobs : int, optional
+        工作进程数量, None 时使用 recConfig.max_process_num, by default None
+    out : str, optional
+        JSON Lines 结果文件, None 时不写文件, by default None
+
+    Returns
+    -------
+    Dict[str, Any]
+        clips、failed、clips_per_sec、p50、p95 和各阶段平均耗时 stages
+    """
+    jobs = jobs or recConfig.max_process_num
+    before = Metrics.snapshot()
+    files = list(AudioDecoder.listDir(dir))
+    log("Have %d audio to recognize with %d processes" % (len(files), jobs))
+    latency, failed = [], 0
+    stages = {"decode": 0.0, "fingerprint": 0.0, "match": 0.0}
+    fh = open(out, "w", encoding="utf-8") if out else None
+    t0 = time.time()
+    try:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=Model._initWorker) as executor:
+            futures = [executor.submit(Model.recognizeFile, filepath, recConfig.channel_strategy) for filepath in files]
+            for finished, future in enumerate(as_completed(futures), 1):
+                result = future.result()
+                # 工作进程中每个文件的统计合并到当前进程
+                Metrics.merge(result.get("metrics"))
+                if "error" in result:
+                    failed += 1
+                    log("Processing %d/%d: %s %s" % (finished, len(files), result["file"], result["error"]))
+                else:
+                    latency.append(result["timing"]["total"])
+                    for stage in stages:
+                        stages[stage] += result["timing"][stage]
+                    log("Processing %d/%d: %s -> %s (confidence: %.2f)" % (finished, len(files), result["file"], result["name"], result["confidence"]))
+                if fh:
+                    fh.write(json.dumps(result, ensure_ascii=False) + "\n")
+    finally:
+        if fh:
+            fh.close()
+
+    elapsed = time.time() - t0
+    summary = {"clips": len(files),
+               "failed": failed,
+               "clips_per_sec": len(files) / elapsed if elapsed > 0 else 0.0,
+               "p50": float(np.percentile(latency, 50)) if latency else 0.0,
+               "p95": float(np.percentile(latency, 95)) if latency else 0.0,
+               "stages": {stage: total / len(latency) if latency else 0.0 for stage, total in stages.items()}}
+    log("Finish! %d clips (%d failed) in %.1f sec, %.2f clips/sec" % (len(files), failed, elapsed, summary["clips_per_sec"]))
+    log("Latency p50: %.3f sec, p95: %.3f sec" % (summary["p50"], summary["p95"]))
+    log("Stage mean: " + ", ".join("%s %.3f sec" % item for item in summary["stages"].items()))
+    reportMetrics("recognize-dir", before, dir=dir, clips=len(files))
+    return summary
+
+@commandWrapper
+def recognizeStream(source):
+    """流式识别, source 为 "-" 时从标准输入读取单声道 s16le PCM, 否则按 recConfig.live_block_seconds 分块解码音频文件"""
+    if source == "-":
+        blocks = AudioDecoder.readPCM(sys.stdin.buffer)
+    else:
+        blocks = AudioDecoder.readStream(source, recConfig.live_block_seconds)
+    log("Listening......")
+    t1 = time.time()
+    found = False
+    for result in Model.recognizeStream(blocks):
+        found = True
+        log("[%.1f sec] %s (fingerprints match: %s), position: %.2f sec, confidence: %.2f" % (result["elapsed"], result["name"], result["count"], result["position"] + result["elapsed"], result["confidence"]))
+    if not found:
+        log("Can not find any song fit this audio")
+    log("Stream end (Time cost: %.2f sec)" % (time.time() - t1))
 
 if __name__ == "__main__":
     pass
\ No newline at end of file
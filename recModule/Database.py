@@ -1,9 +1,11 @@
 from sqlalchemy.ext.declarative import declarative_base
 from recModule.Config import recConfig
-from sqlalchemy import create_engine, Column, Integer, String, Boolean
+from recModule.Fingerprint import FPconfig
+from sqlalchemy import create_engine, inspect, Column, Integer, BigInteger, String, Boolean
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.exc import ProgrammingError, DatabaseError
 from sqlalchemy.pool import NullPool
+import io, os, tempfile
 
 #生成一个SqlORM 基类
 Base = declarative_base()
@@ -33,7 +35,7 @@ class Fingerprints(Base):
 
     id为指纹id\n
     song_id 是外键，记录对应的歌曲信息\n
-    fingerprint就是获取到的指纹信息\n
+    fingerprint就是获取到的指纹信息, 整数哈希模式下为 BigInteger\n
     offset就是该指纹的offset位置
 
     Parameters
@@ -46,9 +48,30 @@ class Fingerprints(Base):
     id = Column(Integer, autoincrement=True, primary_key=True)
     song_id = Column(Integer, index=False)
     # 指纹长度取决于字符串长度
-    fingerprint = Column(String(64), index=True)
+    if FPconfig.hash_mode == "sha256":
+        fingerprint = Column(String(64), index=True)
+    else:
+        fingerprint = Column(BigInteger, index=True)
     offset = Column(Integer)
 
+class Configs(Base):
+    """数据库配置表
+
+    记录建库时使用的配置, 例如 hash_mode, 防止使用不同的指纹模式读写同一个数据库
+
+    Parameters
+    ----------
+    Base : _type_
+        _description_
+    """
+    __tablename__ = 'Configs'
+    # 表结构
+    name = Column(String(64), primary_key=True)
+    value = Column(String(64))
+
+# 加入 Configs 表之前建立的数据库只有 sha256 一种指纹模式
+LEGACY_HASH_MODE = "sha256"
+
 def checkDatabase(conn=recConfig.sqlalchemy_address):
     """连接数据库\n
 
@@ -63,15 +86,32 @@ def checkDatabase(conn=recConfig.sqlalchemy_address):
     -------
     Union[Tuple[bool, int, str], Tuple[bool, str, Any]]
         数据库表非空返回(True, 0, "")否则返回(False, err.code, err.orig)
+        缺少 Songs 或 Fingerprints 表时返回(False, "no_tables", msg)
+        数据库的 hash_mode 与 FPconfig.hash_mode 不一致时返回(False, "hash_mode", msg);
+        没有 Configs 表或其中没有 hash_mode 的旧数据库按 sha256 处理
     """
     try:
         # 链接数据库
         engine = create_engine(conn, poolclass=NullPool)
+        inspector = inspect(engine)
+        missing = [table for table in (Songs.__tablename__, Fingerprints.__tablename__) if not inspector.has_table(table)]
+        if missing:
+            return (False, "no_tables", "missing tables: %s" % ", ".join(missing))
         #创建与数据库的会话sesson
         DBSession = sessionmaker(bind=engine)
         dbs = DBSession()
-        dbs.query(Songs).first()
-        dbs.query(Fingerprints).first()
+        try:
+            dbs.query(Songs).first()
+            dbs.query(Fingerprints).first()
+            hash_mode = None
+            if inspector.has_table(Configs.__tablename__):
+                hash_mode = dbs.query(Configs).filter_by(name="hash_mode").first()
+        finally:
+            # 及时归还连接, 分片后端会在其他线程中检查数据库
+            dbs.close()
+        hash_mode = hash_mode.value if hash_mode is not None else LEGACY_HASH_MODE
+        if hash_mode != FPconfig.hash_mode:
+            return (False, "hash_mode", "database is built with hash mode %s but FPconfig.hash_mode is %s" % (hash_mode, FPconfig.hash_mode))
         return (True, 0, "")
     except ProgrammingError as err:
         return (False, err.code, err.orig)
@@ -93,15 +133,122 @@ def initSession(conn=recConfig.sqlalchemy_address):
     Tuple[sessionmaker, MockConnection]
         返回由sessionmaker和数据库引擎engine组成的元组
     """
-    engine = create_engine(conn, pool_size=recConfig.max_connection)
+    if conn.startswith("sqlite"):
+        # 分片后端会在线程池中使用同一个 engine
+        engine = create_engine(conn, connect_args={"check_same_thread": False})
+    else:
+        engine = create_engine(conn, pool_size=recConfig.max_connection, connect_args=_connectArgs(conn))
     DBSession = sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
     return DBSession, engine
 
+def _connectArgs(conn):
+    """MySQL 驱动需要显式开启 LOAD DATA LOCAL INFILE"""
+    if conn.startswith("mysql+mysqlconnector"):
+        return {"allow_local_infile": True}
+    if conn.startswith("mysql"):
+        return {"local_infile": 1}
+    return {}
+
 def createTables(conn=recConfig.sqlalchemy_address):
-    """Create tables"""
+    """Create tables and record the hash mode"""
     try:
         engine = create_engine(conn, poolclass=NullPool)
         Base.metadata.create_all(engine) # 生成数据库表
+        dbs = sessionmaker(bind=engine)()
+        if dbs.query(Configs).filter_by(name="hash_mode").first() is None:
+            dbs.add(Configs(name="hash_mode", value=FPconfig.hash_mode))
+            dbs.commit()
+        dbs.close()
         return True
     except:
         return False
+
+
+def _writeRows(fh, song_id, fingerprints, batch_size=recConfig.insert_number):
+    """将指纹按 TSV 格式分批写入文件对象"""
+    for st in range(0, len(fingerprints), batch_size):
+        part = fingerprints[st:st + batch_size]
+        fh.write("".join("%d\t%s\t%d\n" % (song_id, fingerprint, offset)
+                         for fingerprint, offset in zip(part["hash"].tolist(), part["offset"].tolist())))
+
+# 各 MySQL 数据库(按链接区分)是否允许 LOAD DATA LOCAL INFILE, 每个链接只检查一次
+_local_infile = {}
+
+def _localInfileEnabled(engine):
+    """服务器是否开启 local_infile, MySQL 8 默认关闭"""
+    key = str(engine.url)
+    if key not in _local_infile:
+        with engine.connect() as conn:
+            _local_infile[key] = bool(int(conn.exec_driver_sql("SELECT @@local_infile").scalar() or 0))
+    return _local_infile[key]
+
+def _loadDataInfile(engine, song_id, fingerprints):
+    """写入临时 TSV 文件后使用 LOAD DATA LOCAL INFILE 导入, 服务器或驱动拒绝时返回 False"""
+    fh = tempfile.NamedTemporaryFile("w", suffix=".tsv", delete=False, encoding="utf-8")
+    try:
+        with fh:
+            _writeRows(fh, song_id, fingerprints)
+        conn = engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("LOAD DATA LOCAL INFILE '%s' INTO TABLE Fingerprints FIELDS TERMINATED BY '\\t' (song_id, fingerprint, `offset`)"
+                           % fh.name.replace("\\", "/"))
+            conn.commit()
+            return True
+        except engine.dialect.dbapi.DatabaseError:
+            # 例如 1148/3948 (服务器关闭了 local_infile) 或 2068 (驱动拒绝读取本地文件)
+            conn.rollback()
+            _local_infile[str(engine.url)] = False
+            return False
+        finally:
+            conn.close()
+    finally:
+        os.remove(fh.name)
+
+def bulkInsertFingerprints(engine, song_id, fingerprints):
+    """批量导入指纹\n
+
+    MySQL 写入临时 TSV 文件后使用 LOAD DATA LOCAL INFILE 导入, 服务器未开启 local_infile 或拒绝导入时改用 executemany,
+    PostgreSQL 通过内存中的 TSV 缓冲使用 COPY 导入,
+    其他数据库(SQLite 等)在单个事务中 executemany
+
+    Parameters
+    ----------
+    engine : Engine
+        数据库引擎
+    song_id : int
+        歌曲 id
+    fingerprints : NDArray
+        以 ("hash", "offset") 为字段的结构化数组
+    """
+    if len(fingerprints) == 0:
+        return
+    dialect = engine.dialect.name
+    if dialect == "mysql" and _localInfileEnabled(engine) and _loadDataInfile(engine, song_id, fingerprints):
+        return
+    if dialect == "postgresql":
+        buf = io.StringIO()
+        _writeRows(buf, song_id, fingerprints)
+        buf.seek(0)
+        conn = engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.copy_expert('COPY "Fingerprints" (song_id, fingerprint, "offset") FROM STDIN', buf)
+            conn.commit()
+        finally:
+            conn.close()
+    else:
+        with engine.begin() as conn:
+            conn.execute(Fingerprints.__table__.insert(),
+                         [{"song_id": song_id, "fingerprint": fingerprint, "offset": offset}
+                          for fingerprint, offset in zip(fingerprints["hash"].tolist(), fingerprints["offset"].tolist())])
+
+def dropFingerprintIndex(engine):
+    """删除 Fingerprints 表的指纹索引, 大量导入前调用"""
+    for index in Fingerprints.__table__.indexes:
+        index.drop(engine, checkfirst=True)
+
+def createFingerprintIndex(engine):
+    """重建 Fingerprints 表的指纹索引, 大量导入后调用"""
+    for index in Fingerprints.__table__.indexes:
+        index.create(engine, checkfirst=True)
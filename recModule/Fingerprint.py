@@ -1,6 +1,5 @@
-from matplotlib import mlab, pyplot as plt
-from scipy.ndimage.morphology import generate_binary_structure, iterate_structure, binary_erosion
-from scipy.ndimage.filters import maximum_filter
+from scipy.ndimage import generate_binary_structure, binary_erosion, maximum_filter1d
+from recModule import Metrics
 import numpy as np
 import hashlib
 
@@ -14,16 +13,89 @@ class FPconfig(object):
     # 值越高，峰值数量越少，精度越低
     minimun_peak_amplitude = 10 # 20
     peak_neighborhood_size = 20 # 25
+    # 峰值邻域形状: "diamond" 为半径 peak_neighborhood_size 的菱形, "rect" 为边长 2 * peak_neighborhood_size + 1 的矩形(更快)
+    peak_footprint = "diamond"
+    # 每个时间片最多保留的峰值数量(按幅度), 0 表示不限制
+    max_peaks_per_frame = 0
     # 通过生成快速组合哈希来获得排序peak
     peak_sort = True
     time_constraint_condition = (9, 200) # (min,max) (9,200)
     fanout_factor = 15 # 20
     fingerprint_cutoff = 0
+    # 指纹哈希模式: "sha256" 为64位十六进制字符串, "int32"/"int64" 将 (freq1, freq2, t_delta) 按位打包成整数
+    # 新建数据库推荐使用 "int32": 生成哈希快 20 倍以上, 索引和缓存也更小;
+    # 默认值保持 "sha256" 以兼容已有的数据库, 切换模式需要用 CreateDatabase.py 新建数据库并重新导入歌曲
+    hash_mode = "sha256"
 
-def getSpecgramArr(sample, fs=2, nfft=FPconfig.fft_window_size, window=mlab.window_hanning, noverlap = int(FPconfig.fft_window_size * FPconfig.fft_overlap_ratio)):
+# 整数哈希模式下 (freq1, freq2, t_delta) 各自占用的位数
+HASH_BITS = {
+    "int32": (12, 12, 8),
+    "int64": (20, 20, 23),
+}
+
+def offsetToSeconds(offset, fs):
+    """将指纹的 offset(频谱图的帧号)转换为秒
+
+
+    相邻两帧相隔一个 FFT 帧移: fft_window_size * (1 - fft_overlap_ratio) 个采样点
+
+    Parameters
+    ----------
+    offset : Union[int, NDArray]
+        帧号或帧号差值
+    fs : int
+        采样频率
+
+    Returns
+    -------
+    Union[float, NDArray]
+        对应的秒数
+    """
+    hop = FPconfig.fft_window_size - int(FPconfig.fft_window_size * FPconfig.fft_overlap_ratio)
+    return offset * hop / fs
+
+def secondsToOffset(seconds, fs):
+    """offsetToSeconds 的逆运算, 返回不超过 seconds 的帧号"""
+    hop = FPconfig.fft_window_size - int(FPconfig.fft_window_size * FPconfig.fft_overlap_ratio)
+    return int(seconds * fs) // hop
+
+def packHash(freq1, freq2, t_delta, mode=FPconfig.hash_mode):
+    """将两点的频率和时间差按位打包成整数哈希
+
+    超出位宽的部分会被截断, int32 模式要求频率索引小于4096且时间差小于256
+
+    Parameters
+    ----------
+    freq1 : Union[int, NDArray]
+        定位点的频率
+    freq2 : Union[int, NDArray]
+        target zone内点的频率
+    t_delta : Union[int, NDArray]
+        两点的时间差
+    mode : str, optional
+        "int32" 或 "int64", by default FPconfig.hash_mode
+
+    Returns
+    -------
+    Union[int, NDArray]
+        打包后的非负整数哈希, 输入为 int64 数组时返回 int64 数组
+    """
+    f_bits, _, t_bits = HASH_BITS[mode]
+    f_mask = (1 << f_bits) - 1
+    t_mask = (1 << t_bits) - 1
+    return (((freq1 & f_mask) << (f_bits + t_bits))
+            | ((freq2 & f_mask) << t_bits)
+            | (t_delta & t_mask))
+
+# getSpecgramArr 单次做 FFT 的帧数, 限制中间结果占用的内存
+SPECGRAM_BLOCK_FRAMES = 1024
+
+def getSpecgramArr(sample, fs=2, nfft=FPconfig.fft_window_size, window=None, noverlap = int(FPconfig.fft_window_size * FPconfig.fft_overlap_ratio)):
     """获得频谱图 spectrum\n
 
-    使用FFT将时域信号转为频域信号并生成频谱图
+    使用FFT将时域信号转为频域信号并生成频谱图\n
+    在 float32 的分帧视图上分块调用 numpy.fft.rfft, 功率谱密度的缩放与 matplotlib.mlab.specgram 一致,
+    对数转换在每一块内原地完成
 
     Parameters
     ----------
@@ -33,27 +105,82 @@ def getSpecgramArr(sample, fs=2, nfft=FPconfig.fft_window_size, window=mlab.wind
         音频的采样频率
     nfft : int, optional
         用于FFT的每个块中使用的数据点的数量, by default FPconfig.fft_window_size
-    window : (x: {__len__}) -> Optional[Any], optional
-        NFFT的长度矢量/帧长 即加窗处理中的窗长, by default mlab.window_hanning
+    window : NDArray, optional
+        长度为 nfft 的窗函数, None 时使用汉宁窗, by default None
     noverlap : int, optional
         帧移 帧长重叠部分 越接近FFT长度 FFT运算次数越多 时间轴上精度越高, by default int(FPconfig.fft_window_size * FPconfig.fft_overlap_ratio)
 
     Returns
     -------
     NDArray
-        对数空间中的频谱
+        对数空间中的频谱, float32, 形状为 (nfft // 2 + 1, 帧数)
     """
+    with Metrics.timer("specgram"):
+        sample = np.asarray(sample, dtype=np.float32)
+        # 样本长度不足一帧时补零
+        if len(sample) < nfft:
+            sample = np.concatenate([sample, np.zeros(nfft - len(sample), dtype=np.float32)])
+        if window is None:
+            window = np.hanning(nfft)
+        window = np.asarray(window, dtype=np.float32)
 
-    spectrum, freqs, t = mlab.specgram(sample, NFFT=nfft, Fs=fs, window=window, noverlap=noverlap)
-    # 转换到对数空间防止数值过大
-    spectrum[spectrum == 0] = 1
-    spectrum = 10 * np.log10(spectrum)
-    # 将负数替换成0，寻找最大值不影响结果
-    spectrum[spectrum == -np.inf] = 0
-    print(np.max(spectrum))
+        step = nfft - noverlap
+        frames = np.lib.stride_tricks.sliding_window_view(sample, nfft)[::step]
+        # 与 mlab.specgram 的 psd 模式相同: 除以 fs 和窗函数能量, 单边谱除直流和奈奎斯特频率外乘2
+        scale = np.float32(1.0 / (fs * np.sum(window.astype(np.float64) ** 2)))
+        doubled = slice(1, -1) if nfft % 2 == 0 else slice(1, None)
+
+        spectrum = np.empty((nfft // 2 + 1, len(frames)), dtype=np.float32)
+        for st in range(0, len(frames), SPECGRAM_BLOCK_FRAMES):
+            block = np.fft.rfft(frames[st:st + SPECGRAM_BLOCK_FRAMES] * window, axis=1)
+            power = np.square(block.real, dtype=np.float32)
+            power += np.square(block.imag, dtype=np.float32)
+            del block
+            power *= scale
+            power[:, doubled] *= 2
+            # 转换到对数空间防止数值过大, 功率为0的点保持为0
+            np.log10(power, out=power, where=power > 0)
+            power *= 10
+            spectrum[:, st:st + SPECGRAM_BLOCK_FRAMES] = power.T
+    Metrics.count("specgram_frames", spectrum.shape[1])
     return spectrum
 
-def getConstellationMap(spectrum, plot=False, min_peak_amp=FPconfig.minimun_peak_amplitude):
+def getLocalMaximum(spectrum, size=FPconfig.peak_neighborhood_size, footprint=FPconfig.peak_footprint):
+    """计算频谱图中每个点邻域内的最大值\n
+
+    菱形邻域通过 size 次 3x3 十字形最大值滤波叠加得到, 矩形邻域拆分为两次一维最大值滤波.
+    先按 reflect 方式向外扩展 size 个点, 结果与 maximum_filter 直接使用大尺寸 footprint 完全一致
+
+    Parameters
+    ----------
+    spectrum : NDArray
+        对数空间中的spectrum(来自getSpectramArr)
+    size : int, optional
+        邻域半径, by default FPconfig.peak_neighborhood_size
+    footprint : str, optional
+        "diamond" 或 "rect", by default FPconfig.peak_footprint
+
+    Returns
+    -------
+    NDArray
+        与 spectrum 形状相同的邻域最大值
+    """
+    if footprint == "rect":
+        filtered = maximum_filter1d(spectrum, 2 * size + 1, axis=0)
+        return maximum_filter1d(filtered, 2 * size + 1, axis=1)
+    # scipy 的 reflect 边界等价于 numpy 的 symmetric 填充
+    filtered = np.pad(spectrum, size, mode="symmetric")
+    for _ in range(size):
+        # 3x3 十字形邻域取最大值, 每次迭代只计算内部区域, 数组各边收缩一个点
+        center = filtered[1:-1, 1:-1]
+        center = np.maximum(center, filtered[:-2, 1:-1])
+        np.maximum(center, filtered[2:, 1:-1], out=center)
+        np.maximum(center, filtered[1:-1, :-2], out=center)
+        np.maximum(center, filtered[1:-1, 2:], out=center)
+        filtered = center
+    return filtered
+
+def getConstellationMap(spectrum, plot=False, min_peak_amp=FPconfig.minimun_peak_amplitude, max_peaks=FPconfig.max_peaks_per_frame):
     """生成星状图Constellation Map\n
 
     对finger print的过滤并提取特征值,通过比较获取同一时间上突出点频率最大的peak
@@ -66,33 +193,42 @@ def getConstellationMap(spectrum, plot=False, min_peak_amp=FPconfig.minimun_peak
         是否显示绘图, by default False
     min_peak_amp : int, optional
         作为峰值peak的最小值, by default FPconfig.minimun_peak_amplitutude
+    max_peaks : int, optional
+        每个时间片最多保留的峰值数量, 0 表示不限制, by default FPconfig.max_peaks_per_frame
 
     Returns
     -------
-    List[Tuple[Any, Any]]
-        2D peaks array [(x1,y1),(x2,y2),.......]
+    NDArray
+        2D peaks array [(x1,y1),(x2,y2),.......], 每行为 (time, frequency)
     """
-    # 获得原始算子
-    struct  = generate_binary_structure(2, 1)
-    neighborhood = iterate_structure(struct, FPconfig.peak_neighborhood_size)
-    # 使用滤波器找到局部最大值
-    local_max = maximum_filter(spectrum, footprint=neighborhood) == spectrum
-    background  = (spectrum == 0)
-    eroded_background = binary_erosion(background, structure=neighborhood, border_value=1)
-    detected_peaks = local_max ^ eroded_background
-    # 提取峰值
-    amps = spectrum[detected_peaks]
-    i, j = np.where(detected_peaks) # 返回满足detected_peaks的索引
-    # 滤波器 峰值
-    amps = amps.flatten() # 降维
-    peaks = zip(j, i, amps)
-    peaks_filtered = [x for x in peaks if x[2] > min_peak_amp]
-    # 获取频率和时间索引
-    frequency_idx = [x[1] for x in peaks_filtered]
-    time_idx = [x[0] for x in peaks_filtered]
-    #print(max(time_idx))
+    with Metrics.timer("peaks"):
+        # 使用滤波器找到局部最大值, 同时过滤幅度
+        detected_peaks = getLocalMaximum(spectrum, FPconfig.peak_neighborhood_size, FPconfig.peak_footprint) == spectrum
+        detected_peaks &= spectrum > min_peak_amp
+        if min_peak_amp < 0:
+            # 幅度阈值非负时背景点(值为0)不会通过过滤, 只有负阈值才需要腐蚀背景
+            struct = generate_binary_structure(2, 1)
+            if FPconfig.peak_footprint == "rect":
+                struct = np.ones((3, 3), dtype=bool)
+            eroded_background = binary_erosion(spectrum == 0, structure=struct, iterations=FPconfig.peak_neighborhood_size, border_value=1)
+            detected_peaks ^= eroded_background
+        # 提取峰值 获取频率和时间索引
+        frequency_idx, time_idx = np.nonzero(detected_peaks) # 返回满足detected_peaks的索引
+
+        if max_peaks > 0 and len(time_idx) > 0:
+            # 每个时间片按幅度降序排名, 只保留前 max_peaks 个
+            amps = spectrum[frequency_idx, time_idx]
+            order = np.lexsort((-amps, time_idx))
+            sorted_time = time_idx[order]
+            starts = np.flatnonzero(np.r_[True, sorted_time[1:] != sorted_time[:-1]])
+            rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+            keep = np.sort(order[rank < max_peaks])
+            frequency_idx = frequency_idx[keep]
+            time_idx = time_idx[keep]
+    Metrics.count("peaks", len(time_idx))
 
     if plot:
+        from matplotlib import pyplot as plt
         # 分散的峰值
         fig, ax = plt.subplots()
         ax.imshow(spectrum)
@@ -106,7 +242,62 @@ def getConstellationMap(spectrum, plot=False, min_peak_amp=FPconfig.minimun_peak
         plt.ylim(0, 400)
         plt.show()
 
-    return list(zip(time_idx, frequency_idx))
+    return np.stack([time_idx, frequency_idx], axis=1)
+
+def getFBHashArray(peaks, fanout_factor=FPconfig.fanout_factor):
+    """通过计算peak之间的时间差,对相应peak和时间差做hash化处理(向量化)\n
+
+    使用滑动窗口视图一次性构造所有 (定位点, target zone内点) 组合, 以布尔掩码按 time_constraint_condition 过滤,
+    组合的选择和顺序与逐个循环的实现完全一致
+
+    Parameters
+    ----------
+    peaks : Union[list[tuple], NDArray]
+        二维峰值阵列 (time, frequency)(来自getConstellationMap)
+    fanout_factor : int, optional
+        fanout常数 值越大生成指纹越多, by default FPconfig.fanout_factor
+
+    Returns
+    -------
+    Tuple[NDArray, NDArray]
+        连续存储的 (hash_array, anchor_time_array), sha256 模式下 hash_array 为字符串数组, 整数模式下为 int64 数组
+    """
+    with Metrics.timer("hashing"):
+        peaks = np.asarray(peaks, dtype=np.int64).reshape(-1, 2)
+        # peak 以时间顺序排序, 时间相同时保持原有顺序
+        if FPconfig.peak_sort:
+            peaks = peaks[np.argsort(peaks[:, 0], kind="stable")]
+        times = np.ascontiguousarray(peaks[:, 0])
+        freqs = np.ascontiguousarray(peaks[:, 1])
+
+        anchors = len(peaks) - fanout_factor
+        if anchors <= 0 or fanout_factor <= 0:
+            if FPconfig.hash_mode == "sha256":
+                return np.empty(0, dtype="U%d" % (64 - FPconfig.fingerprint_cutoff)), np.empty(0, dtype=np.int64)
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        # 第 i 行为定位点 i 及其后 fanout_factor - 1 个点, 与双重循环 peaks[i + j] 一一对应
+        target_times = np.lib.stride_tricks.sliding_window_view(times, fanout_factor)[:anchors]
+        target_freqs = np.lib.stride_tricks.sliding_window_view(freqs, fanout_factor)[:anchors]
+        t_delta = target_times - times[:anchors, None]
+        mask = (t_delta >= FPconfig.time_constraint_condition[0]) & (t_delta <= FPconfig.time_constraint_condition[1])
+
+        # 行优先取出满足条件的组合, 顺序与双重循环相同
+        anchor_idx, _ = np.nonzero(mask)
+        t1 = times[anchor_idx]
+        freq1 = freqs[anchor_idx]
+        freq2 = target_freqs[mask]
+        t_delta = t_delta[mask]
+        Metrics.count("hashes", len(t1))
+
+        # 把两点的频率和时间差组合生成一个哈希，再加上时间位置生成指纹
+        if FPconfig.hash_mode != "sha256":
+            return packHash(freq1, freq2, t_delta, FPconfig.hash_mode), t1
+        # 每对都要计算一次 sha256, 是 sha256 模式的主要耗时; 整数模式快一个数量级以上
+        sha256 = hashlib.sha256
+        hashes = [sha256(b"%d_%d_%d" % triple).hexdigest() for triple in zip(freq1.tolist(), freq2.tolist(), t_delta.tolist())]
+        # 截断在定长字符串数组的 dtype 中完成
+        return np.array(hashes, dtype="U%d" % (64 - FPconfig.fingerprint_cutoff)), t1
 
 def getFBHashGenerator(peaks, fanout_factor=FPconfig.fanout_factor):
     """通过计算peak之间的时间差,对相应peak和时间差做hash化处理
@@ -124,22 +315,127 @@ def getFBHashGenerator(peaks, fanout_factor=FPconfig.fanout_factor):
         Hash list structure:
         sha1_hash   time_offset
         [(e05b341a9b77a51fd26, 32), ... ]
+        整数哈希模式下 hash 为 packHash 生成的整数
+    """
+    hashes, times = getFBHashArray(peaks, fanout_factor)
+    for h, t1 in zip(hashes.tolist(), times.tolist()):
+        yield (h, t1)
+
+def uniqueFingerprints(hashes, offsets):
+    """合并指纹并去重
+
+    Parameters
+    ----------
+    hashes : NDArray
+        指纹哈希数组(来自getFBHashArray), 可以是多段数组拼接后的结果
+    offsets : NDArray
+        与哈希对应的时间 offset
+
+    Returns
+    -------
+    NDArray
+        以 ("hash", "offset") 为字段的结构化数组, 每个 (hash, offset) 只出现一次
+    """
+    hashes = np.asarray(hashes)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    # 先按 hash 再按 offset 排序, 相邻重复项只保留一个
+    order = np.lexsort((offsets, hashes))
+    hashes = hashes[order]
+    offsets = offsets[order]
+    keep = np.ones(len(hashes), dtype=bool)
+    keep[1:] = (hashes[1:] != hashes[:-1]) | (offsets[1:] != offsets[:-1])
+    fingerprints = np.empty(int(keep.sum()), dtype=[("hash", hashes.dtype), ("offset", np.int64)])
+    fingerprints["hash"] = hashes[keep]
+    fingerprints["offset"] = offsets[keep]
+    return fingerprints
+
+class StreamFingerprinter(object):
+    """流式生成指纹\n
+
+    分块输入单声道采样数据, 每次只计算新增的帧, 并保留计算峰值和组合哈希所需的重叠部分:
+    STFT 保留 noverlap 个采样, 峰值检测在两侧各保留 peak_neighborhood_size 列频谱, 组合哈希保留最后 fanout_factor 个峰值.
+    生成的指纹与对整段音频一次性调用 getSpecgramArr、getConstellationMap、getFBHashArray 的结果完全相同,
+    offset 为从音频开始计算的绝对帧号, 内存占用只与分块大小有关
     """
-    # peak 以时间顺序排序
-    if FPconfig.peak_sort:
-        peaks.sort(key=lambda x: x[0])
-
-    # 选择生成指纹的峰值
-    for i in range(len(peaks) - fanout_factor):
-        for j in range(fanout_factor):
-            t1 = peaks[i][0]  # 定位点的时间
-            t2 = peaks[i + j][0]  # target zone内点的时间
-            freq1 = peaks[i][1]  # 定位点的频率
-            freq2 = peaks[i + j][1]  # target zone内点的频率
-            t_delta = t2 - t1
-
-            # 把两点的频率和时间差组合生成一个哈希，再加上时间位置生成指纹
-            if t_delta >= FPconfig.time_constraint_condition[0] and t_delta <= FPconfig.time_constraint_condition[1]:
-                h = hashlib.sha256(
-                    ("%s_%s_%s" % (str(freq1), str(freq2), str(t_delta))).encode())
-                yield (h.hexdigest()[0:64 - FPconfig.fingerprint_cutoff], t1)
+
+    def __init__(self, fs, fanout_factor=FPconfig.fanout_factor):
+        self.fs = fs
+        self.fanout_factor = fanout_factor
+        self.nfft = FPconfig.fft_window_size
+        self.noverlap = int(FPconfig.fft_window_size * FPconfig.fft_overlap_ratio)
+        self.step = self.nfft - self.noverlap
+        self.context = FPconfig.peak_neighborhood_size
+        # 尚未组成完整帧的采样, sample_base 为 samples[0] 的绝对位置
+        self.samples = np.empty(0, dtype=np.float32)
+        self.sample_base = 0
+        self.total_samples = 0
+        # 频谱缓冲, column_base 为 spectrum[:, 0] 的绝对帧号
+        self.spectrum = np.empty((self.nfft // 2 + 1, 0), dtype=np.float32)
+        self.column_base = 0
+        # 已经提取过峰值的列数
+        self.peak_done = 0
+        # 尚未作为定位点使用的峰值 (time, frequency)
+        self.peaks = np.empty((0, 2), dtype=np.int64)
+
+    def feed(self, samples):
+        """输入新的采样数据
+
+        Parameters
+        ----------
+        samples : NDArray
+            单声道采样数据
+
+        Returns
+        -------
+        Tuple[NDArray, NDArray]
+            新确定的 (hash_array, anchor_time_array)
+        """
+        samples = np.asarray(samples, dtype=np.float32)
+        self.total_samples += len(samples)
+        self.samples = np.concatenate([self.samples, samples])
+        frames = (len(self.samples) - self.noverlap) // self.step if len(self.samples) >= self.nfft else 0
+        if frames > 0:
+            used = frames * self.step
+            self._appendColumns(getSpecgramArr(self.samples[:used + self.noverlap], self.fs, self.nfft, noverlap=self.noverlap))
+            self.samples = self.samples[used:]
+            self.sample_base += used
+        return self._extract(final=False)
+
+    def flush(self):
+        """输入结束, 处理剩余的频谱列
+
+        Returns
+        -------
+        Tuple[NDArray, NDArray]
+            剩余的 (hash_array, anchor_time_array)
+        """
+        # 整段音频不足一帧时与 getSpecgramArr 一样补零生成一帧
+        if self.total_samples > 0 and self.column_base + self.spectrum.shape[1] == 0:
+            self._appendColumns(getSpecgramArr(self.samples, self.fs, self.nfft, noverlap=self.noverlap))
+        return self._extract(final=True)
+
+    def _appendColumns(self, columns):
+        self.spectrum = np.concatenate([self.spectrum, columns], axis=1)
+
+    def _extract(self, final):
+        total_columns = self.column_base + self.spectrum.shape[1]
+        # 右侧需要 context 列才能确定峰值, 结束时使用真实边界
+        end = total_columns if final else total_columns - self.context
+        if end > self.peak_done:
+            start = max(self.column_base, self.peak_done - self.context)
+            peaks = getConstellationMap(self.spectrum[:, start - self.column_base:])
+            peaks[:, 0] += start
+            peaks = peaks[(peaks[:, 0] >= self.peak_done) & (peaks[:, 0] < end)]
+            peaks = peaks[np.argsort(peaks[:, 0], kind="stable")]
+            self.peaks = np.concatenate([self.peaks, peaks])
+            self.peak_done = end
+            # 只保留下一次提取峰值所需的左侧频谱
+            drop = max(0, self.peak_done - self.context - self.column_base)
+            self.spectrum = self.spectrum[:, drop:]
+            self.column_base += drop
+
+        hashes, times = getFBHashArray(self.peaks, self.fanout_factor)
+        # 最后 fanout_factor 个峰值还不能作为定位点
+        if len(self.peaks) > self.fanout_factor:
+            self.peaks = self.peaks[len(self.peaks) - self.fanout_factor:]
+        return hashes, times
@@ -0,0 +1,198 @@
+from recModule.Config import recConfig
+from recModule.Fingerprint import FPconfig
+from recModule import Metrics
+import os, json, shutil
+import numpy as np
+
+# 倒排索引目录中的文件
+KEYS_FILE = "keys.npy"
+STARTS_FILE = "starts.npy"
+SONG_IDS_FILE = "song_ids.npy"
+OFFSETS_FILE = "offsets.npy"
+META_FILE = "meta.json"
+
+def _keyArray(hashes, hash_mode):
+    """将指纹哈希转换为索引中 keys 的 dtype, sha256 的十六进制字符串按 ASCII 字节保存"""
+    if hash_mode == "sha256":
+        return np.asarray(hashes).astype("S64")
+    return np.asarray(hashes, dtype=np.int64)
+
+def _checkReplaceable(path):
+    """path 不存在或是含 META_FILE 的索引目录时返回 True(可以删除后替换), 其他已存在的路径抛出 ValueError"""
+    if not os.path.lexists(path):
+        return False
+    if os.path.isdir(path) and not os.path.islink(path) and os.path.isfile(os.path.join(path, META_FILE)):
+        return True
+    raise ValueError("%s already exists and is not an index directory (no %s), refusing to overwrite it" % (path, META_FILE))
+
+def compileIndex(storage, path, hash_mode=None):
+    """将存储后端中的指纹导出为磁盘上的倒排索引\n
+
+    全部指纹按哈希排序后保存为四个 .npy 文件:
+    keys 为去重后有序的哈希, starts 为每个哈希在 postings 中的起始位置(长度为 len(keys) + 1),
+    song_ids 和 offsets 为与之平行的 postings; 歌曲名和 hash_mode 保存在 meta.json 中\n
+    先写入临时目录再替换, 正在使用旧索引的进程不受影响
+
+    Parameters
+    ----------
+    storage : StorageBackend
+        存储后端
+    path : str
+        索引目录
+    hash_mode : str, optional
+        指纹哈希的格式, None 时使用 FPconfig.hash_mode, by default None
+
+    Returns
+    -------
+    Tuple[int, int]
+        postings 数量和不同哈希的数量
+
+    Raises
+    ------
+    ValueError
+        path 或临时目录 path.tmp 已存在但不是索引目录, 例如误把音频目录作为输出路径
+    """
+    hash_mode = hash_mode or FPconfig.hash_mode
+    tmp = path.rstrip(os.sep) + ".tmp"
+    # 在导出指纹之前检查, 只替换以前生成的索引目录
+    _checkReplaceable(path)
+    _checkReplaceable(tmp)
+    song_ids, hashes, offsets = [], [], []
+    for rows in storage.exportFingerprints():
+        s, h, o = zip(*rows)
+        song_ids.append(np.array(s, dtype=np.int32))
+        hashes.append(_keyArray(h, hash_mode))
+        offsets.append(np.array(o, dtype=np.int32))
+        del rows, s, h, o
+    if hashes:
+        song_ids = np.concatenate(song_ids)
+        hashes = np.concatenate(hashes)
+        offsets = np.concatenate(offsets)
+    else:
+        song_ids = np.empty(0, dtype=np.int32)
+        hashes = _keyArray([], hash_mode)
+        offsets = np.empty(0, dtype=np.int32)
+
+    # 按哈希排序, 相同哈希的 postings 连续存放
+    order = np.argsort(hashes, kind="stable")
+    hashes = hashes[order]
+    song_ids = song_ids[order]
+    offsets = offsets[order]
+    del order
+    starts = np.flatnonzero(np.r_[True, hashes[1:] != hashes[:-1]]) if hashes.size else np.empty(0, dtype=np.int64)
+    keys = hashes[starts]
+    starts = np.r_[starts, hashes.size].astype(np.int64)
+    del hashes
+
+    if _checkReplaceable(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    np.save(os.path.join(tmp, KEYS_FILE), keys)
+    np.save(os.path.join(tmp, STARTS_FILE), starts)
+    np.save(os.path.join(tmp, SONG_IDS_FILE), song_ids)
+    np.save(os.path.join(tmp, OFFSETS_FILE), offsets)
+    with open(os.path.join(tmp, META_FILE), "w", encoding="utf-8") as f:
+        json.dump({"hash_mode": hash_mode,
+                   "postings": int(song_ids.size),
+                   "keys": int(keys.size),
+                   "songs": {str(k): v for k, v in storage.exportSongs().items()}}, f, ensure_ascii=False)
+    if _checkReplaceable(path):
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+    return int(song_ids.size), int(keys.size)
+
+
+class MmapIndex(object):
+    """以内存映射方式打开 compileIndex 生成的倒排索引, 识别时不访问数据库"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.hash_mode = meta["hash_mode"]
+        if self.hash_mode != FPconfig.hash_mode:
+            raise ValueError("index hash_mode is %s but FPconfig.hash_mode is %s, please compile the index again" % (self.hash_mode, FPconfig.hash_mode))
+        self.songs = {int(k): v for k, v in meta["songs"].items()}
+        self.keys = np.load(os.path.join(path, KEYS_FILE), mmap_mode="r")
+        self.starts = np.load(os.path.join(path, STARTS_FILE), mmap_mode="r")
+        self.song_ids = np.load(os.path.join(path, SONG_IDS_FILE), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, OFFSETS_FILE), mmap_mode="r")
+
+    def _postings(self, hashes):
+        """在有序的 keys 中二分查找哈希
+
+        Returns
+        -------
+        Tuple[NDArray, NDArray, NDArray]
+            命中的查询下标、对应 postings 的起始位置和 postings 数量
+        """
+        hashes = _keyArray(hashes, self.hash_mode)
+        if self.keys.size == 0 or hashes.size == 0:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty
+        pos = np.searchsorted(self.keys, hashes)
+        np.minimum(pos, self.keys.size - 1, out=pos)
+        found = np.flatnonzero(self.keys[pos] == hashes)
+        pos = pos[found]
+        lo = np.asarray(self.starts[pos])
+        return found, lo, np.asarray(self.starts[pos + 1]) - lo
+
+    def lookupFingerprints(self, hashes):
+        """与 StorageBackend.lookupFingerprints 相同, 返回 (song_id, fingerprint, offset) 行"""
+        # 与 IN 查询一致, 重复的哈希只返回一次
+        hashes = list(dict.fromkeys(hashes))
+        found, lo, counts = self._postings(hashes)
+        rows = []
+        for i, st, n in zip(found.tolist(), lo.tolist(), counts.tolist()):
+            for song_id, offset in zip(self.song_ids[st:st + n].tolist(), self.offsets[st:st + n].tolist()):
+                rows.append((song_id, hashes[i], offset))
+        return rows
+
+    def queryMatches(self, hashes, offsets, batch_size=None):
+        """与 StorageBackend.queryMatches 相同, 一次二分查找后向量化展开全部 postings
+
+        Returns
+        -------
+        Tuple[NDArray, NDArray, NDArray]
+            song_id、索引中的 offset 和查询样本中的 offset 三个等长数组
+        """
+        with Metrics.timer("index_lookup"):
+            found, lo, counts = self._postings(hashes)
+            q_offsets = np.repeat(np.asarray(offsets, dtype=np.int64)[found], counts)
+            # 每个命中哈希的 postings 是连续的一段, 拼接为一个下标数组
+            idx = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(q_offsets.size)
+            song_ids = np.asarray(self.song_ids[idx], dtype=np.int64)
+            db_offsets = np.asarray(self.offsets[idx], dtype=np.int64)
+        Metrics.count("index_hashes", len(hashes))
+        Metrics.count("index_rows", q_offsets.size)
+        return song_ids, db_offsets, q_offsets
+
+    def querySongNames(self, song_ids):
+        return {song_id: self.songs[song_id] for song_id in song_ids if song_id in self.songs}
+
+
+_index = None
+
+def getIndex(path=None):
+    """获取当前进程使用的倒排索引\n
+
+    索引目录被重新编译后自动重新打开
+
+    Parameters
+    ----------
+    path : str, optional
+        索引目录, None 时使用 recConfig.index_path, by default None
+
+    Returns
+    -------
+    Optional[MmapIndex]
+        索引不存在时返回 None
+    """
+    global _index
+    path = path or recConfig.index_path
+    if not path or not os.path.exists(os.path.join(path, META_FILE)):
+        return None
+    mtime = os.path.getmtime(os.path.join(path, META_FILE))
+    if _index is None or _index[0] != (path, mtime):
+        _index = ((path, mtime), MmapIndex(path))
+    return _index[1]
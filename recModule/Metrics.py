@@ -0,0 +1,194 @@
+from recModule.Config import recConfig
+from contextlib import nullcontext
+import os, json, time, threading, tempfile
+
+# 未开启统计时 timer 返回的空上下文, 不分配对象也不计时
+_NULL_TIMER = nullcontext()
+
+class Registry(object):
+    """各阶段的耗时和计数\n
+
+    timers 为名字到 [调用次数, 总耗时(秒), 单次最大耗时(秒)] 的映射, counters 为名字到累计值的映射
+    """
+
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                if seconds > timer[2]:
+                    timer[2] = seconds
+
+    def add(self, name, value):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, snapshot):
+        """合并另一个进程的 snapshot(), 例如进程池中识别单个文件的统计"""
+        with self.lock:
+            for name, item in snapshot.get("timers", {}).items():
+                timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+                timer[0] += item["calls"]
+                timer[1] += item["seconds"]
+                timer[2] = max(timer[2], item["max"])
+            for name, value in snapshot.get("counters", {}).items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        with self.lock:
+            return {"timers": {name: {"calls": calls, "seconds": seconds, "max": longest}
+                               for name, (calls, seconds, longest) in self.timers.items()},
+                    "counters": dict(self.counters)}
+
+    def reset(self):
+        with self.lock:
+            self.timers.clear()
+            self.counters.clear()
+
+
+class Timer(object):
+    """计时上下文, 退出时把耗时记入 Registry, 耗时同时保存在 seconds 属性"""
+    __slots__ = ("registry", "name", "start", "seconds")
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+        self.seconds = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+        self.registry.observe(self.name, self.seconds)
+        return False
+
+
+_registry = Registry()
+
+def enabled():
+    return recConfig.metrics_enabled
+
+def timer(name):
+    """统计一个阶段的耗时\n
+
+    未开启 recConfig.metrics_enabled 时返回空上下文, 开销只有一次属性查询
+
+    Parameters
+    ----------
+    name : str
+        阶段名, 如 "decode"、"specgram"、"peaks"、"hashing"、"db_lookup"、"scoring"
+
+    Returns
+    -------
+    ContextManager
+        with timer("decode"): ...
+    """
+    if not recConfig.metrics_enabled:
+        return _NULL_TIMER
+    return Timer(_registry, name)
+
+def count(name, value=1):
+    """累加一个计数, 如峰值数、哈希数、数据库返回的行数和解码的字节数"""
+    if recConfig.metrics_enabled:
+        _registry.add(name, value)
+
+def merge(snapshot):
+    if snapshot:
+        _registry.merge(snapshot)
+
+def snapshot():
+    """当前进程的统计
+
+    Returns
+    -------
+    Dict[str, Dict]
+        {"timers": {名字: {"calls", "seconds", "max"}}, "counters": {名字: 值}}
+    """
+    return _registry.snapshot()
+
+def reset():
+    _registry.reset()
+
+def diff(after, before):
+    """两次 snapshot() 之间新增的统计, 用于单个命令的统计; max 无法相减, 取 after 中的值"""
+    timers = {}
+    for name, item in after["timers"].items():
+        old = before["timers"].get(name, {"calls": 0, "seconds": 0.0})
+        if item["calls"] > old["calls"]:
+            timers[name] = {"calls": item["calls"] - old["calls"], "seconds": item["seconds"] - old["seconds"], "max": item["max"]}
+    counters = {name: value - before["counters"].get(name, 0) for name, value in after["counters"].items()
+                if value != before["counters"].get(name, 0)}
+    return {"timers": timers, "counters": counters}
+
+def toPrometheus(data=None, prefix="recsong"):
+    """转换为 Prometheus 文本格式
+
+    每个阶段输出 <prefix>_stage_seconds_total、<prefix>_stage_calls_total 和 <prefix>_stage_seconds_max,
+    以 stage 标签区分; 每个计数输出 <prefix>_<名字>_total
+
+    Parameters
+    ----------
+    data : Dict, optional
+        snapshot() 的结果, None 时使用当前进程的统计, by default None
+    prefix : str, optional
+        指标名前缀, by default "recsong"
+
+    Returns
+    -------
+    str
+        Prometheus 文本格式
+    """
+    data = data or snapshot()
+    timers = sorted(data["timers"].items())
+    lines = []
+    for metric, key, kind in (("stage_seconds_total", "seconds", "counter"),
+                              ("stage_calls_total", "calls", "counter"),
+                              ("stage_seconds_max", "max", "gauge")):
+        lines.append("# TYPE %s_%s %s" % (prefix, metric, kind))
+        lines.extend('%s_%s{stage="%s"} %s' % (prefix, metric, name, repr(item[key])) for name, item in timers)
+    for name, value in sorted(data["counters"].items()):
+        lines.append("# TYPE %s_%s_total counter" % (prefix, name))
+        lines.append("%s_%s_total %s" % (prefix, name, repr(value)))
+    return "\n".join(lines) + "\n"
+
+def writePrometheus(path=None, data=None):
+    """以 Prometheus 文本格式写入文件, 供 node_exporter 的 textfile collector 读取; 先写临时文件再替换
+
+    Parameters
+    ----------
+    path : str, optional
+        目标文件, None 时使用 recConfig.metrics_prometheus_path, 两者都为空时不写入, by default None
+    data : Dict, optional
+        snapshot() 的结果, None 时使用当前进程的统计, by default None
+    """
+    path = path or recConfig.metrics_prometheus_path
+    if not path:
+        return
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(suffix=".prom", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as fh:
+            fh.write(toPrometheus(data))
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+def logLine(data=None, **fields):
+    """转换为一行 JSON 日志, fields 中的字段(如命令名、文件名)写在最前面"""
+    data = data or snapshot()
+    record = dict(fields)
+    record["time"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    record["timers"] = data["timers"]
+    record["counters"] = data["counters"]
+    return json.dumps(record, ensure_ascii=False, default=str)
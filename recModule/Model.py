@@ -1,10 +1,9 @@
-from recModule import Database, AudioDecoder, Fingerprint
+from recModule import Storage, Index, Cache, AudioDecoder, Fingerprint, Scoring, Metrics
 from recModule.Config import recConfig
-from sqlalchemy.orm import scoped_session
-import os, gc, threading, multiprocessing
+import os, gc, time, subprocess, multiprocessing
+import numpy as np
 
 class Audio(object):
-    db, db_engine = Database.initSession()
 
     def __init__(self, filepath, filename, filehash):
         self.filepath = filepath
@@ -70,38 +69,102 @@ class Audio(object):
         bool
             是否进行 fingerprint 处理
         """
-        dbs = self.db()
-        result = dbs.query(Database.Songs).filter_by(filehash=self.filehash).first()
+        result = Storage.getStorage().getSong(self.filehash)
         if result == None:
             return False
-        return result.fingerprinted
+        return result[2]
 
-    def read(self):
+    def read(self, channel_strategy=None):
         """通过 Audio对象的 filepath 得到音频的采样频率 fs 和通道数 channels 属性
 
+        Parameters
+        ----------
+        channel_strategy : str, optional
+            声道处理方式, None 时使用 recConfig.channel_strategy, by default None
         """
-        self.fs, self.channels = AudioDecoder.read(self.filepath)
+        self.fs, self.channels = AudioDecoder.read(self.filepath, channel_strategy or recConfig.channel_strategy)
 
     def getFingerprints(self):
         """获得 fingerprints
 
-        通过调用Fingerprint中的相应方法获得fingerprints
+        通过调用Fingerprint中的相应方法获得fingerprints, 结果为以 ("hash", "offset") 为字段的结构化数组
         """
-        fingerprints = set()
+        hashes, offsets = [], []
         for channel in self.channels:
             arr = Fingerprint.getSpecgramArr(channel, self.fs)
             peaks = Fingerprint.getConstellationMap(arr)
             del arr
-            fp = Fingerprint.getFBHashGenerator(peaks)
+            h, t = Fingerprint.getFBHashArray(peaks)
             del peaks
-            # 获得不同通道的unioin
-            fingerprints |= set(fp)
+            hashes.append(h)
+            offsets.append(t)
 
-        self.fingerprints = fingerprints
-        del fingerprints
+        # 获得不同通道的unioin
+        self.fingerprints = Fingerprint.uniqueFingerprints(np.concatenate(hashes), np.concatenate(offsets))
+        del hashes, offsets
         gc.collect()
         return
 
+    def prepareFingerprints(self, channel_strategy=None):
+        """获得 fingerprints, 优先使用磁盘缓存
+
+        命中 recConfig.fingerprint_cache_dir 中的缓存时不解码音频, 否则调用 read 和 getFingerprints 并写入缓存
+
+        Parameters
+        ----------
+        channel_strategy : str, optional
+            声道处理方式, None 时使用 recConfig.channel_strategy, by default None
+
+        Returns
+        -------
+        bool
+            音频读取失败时返回 False
+        """
+        self.fingerprints = Cache.loadFingerprints(self.filehash, channel_strategy)
+        if self.fingerprints is not None:
+            self.fs = recConfig.audio_frame_rate
+            return True
+        self.read(channel_strategy)
+        if not self.channels:
+            return False
+        self.getFingerprints()
+        Cache.saveFingerprints(self.filehash, self.fingerprints, channel_strategy)
+        return True
+
+    def iterFingerprints(self, chunk_seconds=None, channel_strategy=None):
+        """流式获得 fingerprints
+
+        分块解码音频, 每个声道使用一个 StreamFingerprinter, 内存占用与音频长度无关
+
+        Parameters
+        ----------
+        chunk_seconds : int, optional
+            每块音频的长度(秒), None 时使用 recConfig.stream_chunk_seconds, by default None
+        channel_strategy : str, optional
+            声道处理方式, None 时使用 recConfig.channel_strategy, by default None
+
+        Yields
+        ------
+        NDArray
+            以 ("hash", "offset") 为字段的结构化数组, offset 为从音频开始计算的绝对帧号
+
+        Raises
+        ------
+        ValueError
+            音频读取失败, 没有解码出任何采样
+        """
+        self.fs = recConfig.audio_frame_rate
+        fingerprinters = None
+        for channels in AudioDecoder.readStream(self.filepath, chunk_seconds or recConfig.stream_chunk_seconds, channel_strategy or recConfig.channel_strategy):
+            if fingerprinters is None:
+                fingerprinters = [Fingerprint.StreamFingerprinter(self.fs) for _ in channels]
+            hashes, offsets = zip(*[fp.feed(channel) for fp, channel in zip(fingerprinters, channels)])
+            yield Fingerprint.uniqueFingerprints(np.concatenate(hashes), np.concatenate(offsets))
+        if fingerprinters is None:
+            raise ValueError("read audio fail: %s" % self.filepath)
+        hashes, offsets = zip(*[fp.flush() for fp in fingerprinters])
+        yield Fingerprint.uniqueFingerprints(np.concatenate(hashes), np.concatenate(offsets))
+
     def getId(self, new=False):
         """获取id
 
@@ -117,194 +180,453 @@ class Audio(object):
         int
             返回对象的id
         """
-        dbs = self.db()
-        result = dbs.query(Database.Songs).filter_by(filehash=self.filehash).first()
+        storage = Storage.getStorage()
+        result = storage.getSong(self.filehash)
         if result != None:
-            self.id = result.id
-            self.name = result.name
-            return result.id
+            self.id, self.name, _ = result
+            return self.id
         if new:
-            song0 = Database.Songs(name=self.filename, filehash=self.filehash)
-            dbs.add(song0)
-            dbs.commit()
-            self.id = song0.id
+            self.id = storage.addSong(self.filename, self.filehash)
             self.name = self.filename
-            dbs.close()
-            return song0.id
+            return self.id
         else:
             return -1
 
-    def startInsertFingerprints(self, thread_num=recConfig.max_connection, insert_num=recConfig.insert_number):
-        dbs = self.db()
-        song = dbs.query(Database.Songs).filter_by(id=self.id).first()
-        if song.fingerprinted:
+    def startInsertFingerprints(self):
+        """批量导入指纹
+
+        通过存储后端一次性导入全部指纹并标记歌曲已处理, 同时使这些哈希的缓存失效
+        """
+        storage = Storage.getStorage()
+        if self.isFingerprinted():
             print("This song already be fingerprinted")
             return
-        fingerprints = list(self.fingerprints)
-        st = 0
-        total_threads = []
-        running_threads = []
-        while True:
-            if (st+1)*insert_num > len(fingerprints):
-                total_threads.append(_insertFingerprints(st, self.db, self.id, fingerprints[st*insert_num::]))
-                break
-            else:
-                total_threads.append(_insertFingerprints(st, self.db, self.id, fingerprints[st*insert_num:(st+1)*insert_num:]))
-            st += 1
-        st = 0
-        while st < len(total_threads):
-            if len(running_threads) < thread_num:
-                total_threads[st].start()
-                running_threads.append(total_threads[st])
-                st += 1
-                continue
-            for t in running_threads:
-                if not t.is_alive():
-                    running_threads.remove(t)
-        for t in total_threads:
-            t.join()
-        song.fingerprinted = True
-        dbs.commit()
-        dbs.close()
-
-    # 单线程
-    def insertFingerprints(self):
-        """插入数据
-
-        往数据库Fingerprints表中插入对应数据
+        storage.insertFingerprints(self.id, self.fingerprints)
+        storage.setFingerprinted(self.id)
+        # 新写入的哈希的 postings 已经变化, 识别进程池中的缓存无法逐项失效, 直接关闭进程池
+        Cache.getCache().invalidate(self.fingerprints["hash"].tolist())
+        closePool()
+
+    def startInsertFingerprintsStream(self, chunk_seconds=None):
+        """流式生成并插入指纹
+
+        每生成一块指纹就插入数据库, 不在内存中保存整首歌曲的指纹
+
+        Parameters
+        ----------
+        chunk_seconds : int, optional
+            每块音频的长度(秒), None 时使用 recConfig.stream_chunk_seconds, by default None
+
+        Returns
+        -------
+        Optional[int]
+            插入的指纹数量, 音频读取失败时返回 None, 此时不标记为已生成指纹
         """
-        ss = scoped_session(self.db)
-        dbs = ss()
-        song = dbs.query(Database.Songs).fliter_by(id=self.id).first()
-        if song.fingerprinted:
+        storage = Storage.getStorage()
+        if self.isFingerprinted():
             print("This song already be fingerprinted")
-            return
-        # 插入数据
-        dbs.execute(Database.Fingerprints.__table__.insert(), [{"song_id": self.id, "fingerprint": fingerprint, "offset": int(offset)} for fingerprint, offset in self.fingerprints])
-        song.fingerprinted = True
-        dbs.commit()
-        dbs.close()
-        ss.remove()
+            return 0
+        total = 0
+        try:
+            for fingerprints in self.iterFingerprints(chunk_seconds):
+                storage.insertFingerprints(self.id, fingerprints)
+                Cache.getCache().invalidate(fingerprints["hash"].tolist())
+                total += len(fingerprints)
+        except (OSError, ValueError, subprocess.CalledProcessError):
+            # 探测声道或启动 ffmpeg 失败, 以及没有解码出任何采样, 都发生在插入第一块指纹之前
+            return None
+        storage.setFingerprinted(self.id)
+        closePool()
+        return total
 
     # 使用单一进程
     def recognize_s(self):
         """识别歌曲
 
         1、获取输入的音频的fingerprint
-        2、对每一个fingerprint，在数据库中的搜索相同的fingerprint，并将指纹对应的歌曲信息，以及offset偏移值保存。
-        3、有相同 offset差值 越多的 歌曲 就是识别出的歌曲
+        2、编译过倒排索引时在索引中二分查找, 否则将fingerprint分批, 每批通过一次 IN 查询在数据库中搜索相同的fingerprint，并保存 song_id 以及offset偏移值。
+        3、有相同 offset差值(带符号) 越多的 歌曲 就是识别出的歌曲
 
         Returns
         -------
-        Dict[str, Union[str, int]]
-            返回最可能的曲目的 id、name和count
+        Dict[str, Any]
+            识别结果, 字段见 _buildResult
         """
-        dbs = self.db()
-        matches = []
-        songs = {}
-
-        # 获取所有匹配的指纹
-        for fingerprint, offest in self.fingerprints:
-            # 查找所有与记录匹配的哈希
-            result = dbs.query(Database.Fingerprints).filter_by(fingerprint=fingerprint).all()
-            for r in result:
-                s = dbs.query(Database.Songs).filter_by(id=r.song_id).first()
-                matches.append((str(s.id), str(abs(r.offset-offest))))
-                if not (str(s.id)) in songs:
-                    songs[str(s.id)] = s.name
-
-        posibility = {}
-        mostpossible = {"id":"", "name":"", "count":0}
-        largest = 0
-        for song_id, offest_diff in matches:
-            if not song_id in posibility:
-                posibility[song_id] = dict()
-            if not offest_diff in posibility[song_id]:
-                posibility[song_id][offest_diff] = 0
-            posibility[song_id][offest_diff] += 1
-            if posibility[song_id][offest_diff] > largest:
-                largest = posibility[song_id][offest_diff]
-                mostpossible["id"] = song_id
-                mostpossible["name"] = songs[song_id]
-                mostpossible["count"] = largest
+        storage = getMatcher()
 
-        return mostpossible
+        # 分批获取所有匹配的指纹
+        song_ids, db_offsets, query_offsets = storage.queryMatches(self.fingerprints["hash"], self.fingerprints["offset"])
+        top_ids, top_deltas, top_counts = Scoring.scoreMatches(song_ids, db_offsets - query_offsets, recConfig.result_candidates)
+        return _buildResult(storage, zip(top_ids.tolist(), top_deltas.tolist(), top_counts.tolist()), len(self.fingerprints), self.fs)
+
+    def recognizeEarly(self, batch_size=None, min_count=None, min_ratio=None):
+        """识别歌曲, 结果足够确定时提前结束
+
+        按查询样本中的时间顺序分批查询指纹并累加 offset 差值直方图,
+        最高得分不少于 min_count 且不少于第二名的 min_ratio 倍时停止查询剩余的指纹
+
+        Parameters
+        ----------
+        batch_size : int, optional
+            每批查询的指纹数量, None 时使用 recConfig.early_exit_batch_size, by default None
+        min_count : int, optional
+            None 时使用 recConfig.early_exit_min_count, by default None
+        min_ratio : float, optional
+            None 时使用 recConfig.early_exit_min_ratio, by default None
+
+        Returns
+        -------
+        Dict[str, Any]
+            识别结果, 字段见 _buildResult, 其中 hashes 为实际查询的指纹数量
+        """
+        batch_size = batch_size or recConfig.early_exit_batch_size
+        min_count = min_count or recConfig.early_exit_min_count
+        min_ratio = min_ratio or recConfig.early_exit_min_ratio
+        storage = getMatcher()
+
+        fingerprints = self.fingerprints[np.argsort(self.fingerprints["offset"], kind="stable")]
+        histogram = Scoring.MatchHistogram()
+        consumed = 0
+        top = []
+        for st in range(0, len(fingerprints), batch_size):
+            batch = fingerprints[st:st + batch_size]
+            song_ids, db_offsets, query_offsets = storage.queryMatches(batch["hash"], batch["offset"])
+            histogram.add(song_ids, db_offsets - query_offsets)
+            consumed += len(batch)
+            top = histogram.top(2)
+            runner_up = top[1][2] if len(top) > 1 else 0
+            if top and top[0][2] >= min_count and top[0][2] >= min_ratio * max(runner_up, 1):
+                break
+
+        return _buildResult(storage, histogram.top(recConfig.result_candidates), consumed, self.fs)
 
     # 使用多进程
     def recognize(self):
-        ss = scoped_session(self.db)
-        dbs = ss()
-        matches = []
-        p = multiprocessing.Pool()
-        result = p.map(_matchFingerprints,(data for data in self.fingerprints))
-        p.close()
-        p.join()
+        """使用进程池识别歌曲
+
+        指纹按哈希去重后切分为 recConfig.max_process_num 个大块, 每个工作进程使用自己的存储连接
+        查询一整块并返回 song_id 和 offset 差值数组; 指纹较少时直接在当前进程查询
+
+        Returns
+        -------
+        Dict[str, Any]
+            识别结果, 字段见 _buildResult
+        """
+        hashes, offsets = self.fingerprints["hash"], self.fingerprints["offset"]
+        chunks = min(recConfig.max_process_num, -(-len(hashes) // recConfig.query_batch_size))
+        if chunks <= 1:
+            return self.recognize_s()
+
+        # 相同哈希放在同一块中, 每个哈希只查询一次: 切分点取在最接近等分位置的哈希段起点
+        order = np.argsort(hashes, kind="stable")
+        hashes, offsets = hashes[order], offsets[order]
+        run_starts = np.flatnonzero(np.r_[True, hashes[1:] != hashes[:-1]])
+        targets = np.arange(1, chunks) * len(hashes) // chunks
+        splits = np.unique(run_starts[np.minimum(np.searchsorted(run_starts, targets), len(run_starts) - 1)])
+        splits = splits[splits > 0]
+        tasks = zip(np.split(hashes, splits), np.split(offsets, splits))
+        result = getPool().map(_matchChunk, tasks)
         for r in result:
-            matches.extend(r)
-        posibility = {}
-        mostpossible = {"id":"","name":"","count":0}
-        largest = 0
-        for song_id,offest_diff in matches:
-            if not song_id in posibility:
-                posibility[song_id] = dict()
-            if not offest_diff in posibility[song_id]:
-                posibility[song_id][offest_diff] = 0
-            posibility[song_id][offest_diff] += 1
-            if posibility[song_id][offest_diff] > largest:
-                largest = posibility[song_id][offest_diff]
-                mostpossible["id"] = song_id
-                mostpossible["name"] = dbs.query(Database.Songs).filter_by(id=song_id).first().name
-                mostpossible["count"] = largest
-
-        dbs.close()
-        ss.remove()
-        return mostpossible
+            Metrics.merge(r[2])
+        song_ids = np.concatenate([r[0] for r in result])
+        deltas = np.concatenate([r[1] for r in result])
+        top_ids, top_deltas, top_counts = Scoring.scoreMatches(song_ids, deltas, recConfig.result_candidates)
+        return _buildResult(getMatcher(), zip(top_ids.tolist(), top_deltas.tolist(), top_counts.tolist()), len(hashes), self.fs)
 
     def cleanup(self):
         del self.fingerprints
         del self.channels
         gc.collect()
 
-class _insertFingerprints(threading.Thread):
-    def __init__(self, threadID, db, song_id, data):
-        threading.Thread.__init__(self)
-        self.threadID = threadID
-        self.db = db
-        self.song_id = song_id
-        self.data = data
-
-    def run(self):
-        ss = scoped_session(self.db)
-        dbs = ss()
-        dbs.execute(Database.Fingerprints.__table__.insert(),[{"song_id":self.song_id,"fingerprint":fingerprint, "offset":int(offset)} for fingerprint, offset in self.data])
-        dbs.commit()
-        dbs.close()
-        ss.remove()
-
-
-class _getFingerprints(threading.Thread):
-    def __init__(self, threadID,audio):
-        threading.Thread.__init__(self)
-        self.threadID = threadID
-        self.audio = audio
-    def run(self):
-        if self.audio.channels is None:
-            self.audio.read()
-        self.audio.getFingerprints()
-
-
-def _matchFingerprints(data):
-    fp, offset = data
-    db, e = Database.initSession()
-    ss = scoped_session(db)
-    dbs = ss()
-    matches = []
-    try:
-        for r in dbs.query(Database.Fingerprints).filter_by(fingerprint=fp).all():
-            s = dbs.query(Database.Songs).filter_by(id=r.song_id).first()
-            matches.append((str(s.id), str(abs(r.offset - offset))))
-    finally:
-        dbs.close()
-        ss.remove()
-
-    return matches
\ No newline at end of file
+class StreamRecognizer(object):
+    """流式识别, 用于麦克风、正在写入的文件或套接字等持续输入的音频
+
+
+    每块输入的音频只计算新增的指纹并只查询一次, 匹配结果按查询样本中的时间保留在滚动窗口内;
+    窗口内得分最高的歌曲满足 early_exit_min_count 和 early_exit_min_ratio 时输出结果,
+    同一首歌曲只在首次识别出时输出一次
+
+    Parameters
+    ----------
+    fs : int, optional
+        采样频率, by default recConfig.audio_frame_rate
+    window_seconds : float, optional
+        滚动窗口长度(秒), None 时使用 recConfig.live_window_seconds, by default None
+    channel_strategy : str, optional
+        多声道输入的处理方式, None 时使用 recConfig.channel_strategy, by default None
+    """
+
+    def __init__(self, fs=recConfig.audio_frame_rate, window_seconds=None, channel_strategy=None):
+        self.fs = fs
+        self.channel_strategy = channel_strategy or recConfig.channel_strategy
+        self.window = int(round((window_seconds or recConfig.live_window_seconds) / Fingerprint.offsetToSeconds(1, fs)))
+        self.fingerprinters = None
+        self.storage = getMatcher()
+        # 窗口内的匹配结果
+        self.song_ids = np.empty(0, dtype=np.int64)
+        self.deltas = np.empty(0, dtype=np.int64)
+        self.query_offsets = np.empty(0, dtype=np.int64)
+        # 窗口内每个查询指纹的 offset, 用于计算 coverage
+        self.hash_offsets = np.empty(0, dtype=np.int64)
+        self.samples = 0
+        self.last_id = None
+
+    def feed(self, channels):
+        """输入一块音频
+
+        Parameters
+        ----------
+        channels : Union[NDArray, List[NDArray]]
+            单声道采样数据, 或各声道采样数据组成的列表
+
+        Returns
+        -------
+        Optional[Dict[str, Any]]
+            识别出新的歌曲时返回识别结果(字段见 _buildResult, 另有 elapsed 为已输入音频的秒数), 否则返回 None
+        """
+        if isinstance(channels, np.ndarray) and channels.ndim == 1:
+            channels = [channels]
+        channels = AudioDecoder.mixChannels(list(channels), self.channel_strategy)
+        if self.fingerprinters is None:
+            self.fingerprinters = [Fingerprint.StreamFingerprinter(self.fs) for _ in channels]
+        self.samples += len(channels[0])
+        return self._match([fp.feed(channel) for fp, channel in zip(self.fingerprinters, channels)])
+
+    def flush(self):
+        """输入结束, 处理剩余的采样
+
+        Returns
+        -------
+        Optional[Dict[str, Any]]
+            与 feed 相同
+        """
+        if self.fingerprinters is None:
+            return None
+        return self._match([fp.flush() for fp in self.fingerprinters])
+
+    def _match(self, results):
+        hashes, offsets = zip(*results)
+        fingerprints = Fingerprint.uniqueFingerprints(np.concatenate(hashes), np.concatenate(offsets))
+        # 只查询新增的指纹
+        song_ids, db_offsets, query_offsets = self.storage.queryMatches(fingerprints["hash"], fingerprints["offset"])
+        self.song_ids = np.concatenate([self.song_ids, song_ids])
+        self.deltas = np.concatenate([self.deltas, db_offsets - query_offsets])
+        self.query_offsets = np.concatenate([self.query_offsets, query_offsets])
+        self.hash_offsets = np.concatenate([self.hash_offsets, fingerprints["offset"].astype(np.int64)])
+
+        # 丢弃滑出窗口的匹配结果
+        start = Fingerprint.secondsToOffset(self.samples / self.fs, self.fs) - self.window
+        keep = self.query_offsets >= start
+        self.song_ids, self.deltas, self.query_offsets = self.song_ids[keep], self.deltas[keep], self.query_offsets[keep]
+        self.hash_offsets = self.hash_offsets[self.hash_offsets >= start]
+
+        top_ids, top_deltas, top_counts = Scoring.scoreMatches(self.song_ids, self.deltas, recConfig.result_candidates)
+        if top_ids.size == 0 or top_ids[0] == self.last_id:
+            return None
+        runner_up = top_counts[1] if top_ids.size > 1 else 0
+        if top_counts[0] < recConfig.early_exit_min_count or top_counts[0] < recConfig.early_exit_min_ratio * max(runner_up, 1):
+            return None
+        self.last_id = top_ids[0]
+        result = _buildResult(self.storage, zip(top_ids.tolist(), top_deltas.tolist(), top_counts.tolist()), len(self.hash_offsets), self.fs)
+        result["elapsed"] = self.samples / self.fs
+        return result
+
+def recognizeStream(blocks, fs=recConfig.audio_frame_rate, window_seconds=None, channel_strategy=None):
+    """对持续输入的音频块进行流式识别
+
+    Parameters
+    ----------
+    blocks : Iterable[Union[NDArray, List[NDArray]]]
+        音频块, 例如 AudioDecoder.readPCM 或 AudioDecoder.readStream 的输出
+    fs, window_seconds, channel_strategy :
+        见 StreamRecognizer
+
+    Yields
+    ------
+    Dict[str, Any]
+        每识别出一首新的歌曲输出一次识别结果
+    """
+    recognizer = StreamRecognizer(fs, window_seconds, channel_strategy)
+    for block in blocks:
+        result = recognizer.feed(block)
+        if result is not None:
+            yield result
+    result = recognizer.flush()
+    if result is not None:
+        yield result
+
+def _buildResult(storage, top, hashes, fs=None):
+    """根据得分最高的若干首歌曲生成识别结果
+
+    Parameters
+    ----------
+    storage : Union[Index.MmapIndex, Storage.StorageBackend]
+        用于查询歌曲名
+    top : Iterable[Tuple[int, int, int]]
+        按得分降序排列的 (song_id, 峰值处的 delta, 峰值计数)
+    hashes : int
+        参与匹配的查询指纹数量
+    fs : int, optional
+        查询样本的采样频率, None 时使用 recConfig.audio_frame_rate, by default None
+
+    Returns
+    -------
+    Dict[str, Any]
+        id、name、count 为最可能的曲目;
+        position 为查询样本开头在该曲目中的位置(秒);
+        coverage 为与该位置对齐的查询指纹比例;
+        confidence = 1 - max(第二名得分, recConfig.confidence_min_count) / 最高得分, 不小于 0,
+        只有一个候选或最高得分很低时不会给出高置信度;
+        hashes 为参与匹配的查询指纹数量;
+        candidates 为按得分降序排列的候选曲目, 每项包含 id、name、count 和 position
+    """
+    fs = fs or recConfig.audio_frame_rate
+    top = list(top)
+    mostpossible = {"id":"", "name":"", "count":0, "position":0.0, "coverage":0.0, "confidence":0.0, "hashes":hashes, "candidates":[]}
+    if not top:
+        return mostpossible
+
+    # 最后一次性查询所有候选歌曲名
+    names = storage.querySongNames([song_id for song_id, _, _ in top])
+    mostpossible["candidates"] = [{"id":str(song_id),
+                                   "name":names.get(song_id, ""),
+                                   "count":count,
+                                   "position":float(Fingerprint.offsetToSeconds(delta, fs))} for song_id, delta, count in top]
+    best = mostpossible["candidates"][0]
+    mostpossible["id"] = best["id"]
+    mostpossible["name"] = best["name"]
+    mostpossible["count"] = best["count"]
+    mostpossible["position"] = best["position"]
+    mostpossible["coverage"] = best["count"] / hashes if hashes else 0.0
+    # 第二名得分不低于偶然对齐的数量, 单个候选的置信度也取决于其对齐的指纹数
+    runner_up = max(top[1][2] if len(top) > 1 else 0, recConfig.confidence_min_count)
+    mostpossible["confidence"] = max(0.0, 1 - runner_up / best["count"])
+    return mostpossible
+
+def getMatcher():
+    """识别时使用的查询对象, 存在倒排索引时使用索引, 否则使用存储后端
+
+    Returns
+    -------
+    Union[Index.MmapIndex, Storage.StorageBackend]
+        提供 queryMatches 和 querySongNames 的对象
+    """
+    index = Index.getIndex()
+    if index is not None:
+        return index
+    return Storage.getStorage()
+
+def fingerprintFile(filepath, channel_strategy=None, filehash=None):
+    """在子进程中解码音频并生成指纹
+
+    Parameters
+    ----------
+    filepath : str
+        音频文件路径
+    channel_strategy : str, optional
+        声道处理方式, None 时使用 recConfig.channel_strategy, by default None
+    filehash : str, optional
+        音频文件的 sha256, 给出时使用指纹磁盘缓存, by default None
+
+    Returns
+    -------
+    Optional[NDArray]
+        以 ("hash", "offset") 为字段的结构化数组, 读取失败时返回 None
+    """
+    audio = Audio(filepath, None, filehash)
+    if not audio.prepareFingerprints(channel_strategy):
+        return None
+    return audio.fingerprints
+
+def recognizeFile(filepath, channel_strategy=None):
+    """在子进程中识别一个音频文件并记录各阶段耗时
+
+    Parameters
+    ----------
+    filepath : str
+        音频文件路径
+    channel_strategy : str, optional
+        声道处理方式, None 时使用 recConfig.channel_strategy, by default None
+
+    Returns
+    -------
+    Dict[str, Any]
+        识别结果(字段见 _buildResult), 另有 file 和各阶段耗时 timing(秒): decode、fingerprint、match、total;
+        读取失败时只有 file、error 和 timing; 开启 recConfig.metrics_enabled 时另有该文件的统计 metrics(见 Metrics.snapshot)
+    """
+    timing = {}
+    # 工作进程每次只统计当前文件
+    if Metrics.enabled():
+        Metrics.reset()
+    t0 = time.perf_counter()
+    filehash = AudioDecoder.generateFilehash(filepath) if recConfig.fingerprint_cache_dir else None
+    audio = Audio(filepath, os.path.splitext(os.path.split(filepath)[1])[0], filehash)
+    # 命中指纹磁盘缓存时 decode 为 0, fingerprint 为读取缓存的耗时
+    audio.fingerprints = Cache.loadFingerprints(filehash, channel_strategy)
+    if audio.fingerprints is None:
+        audio.read(channel_strategy)
+        t1 = time.perf_counter()
+        timing["decode"] = t1 - t0
+        if not audio.channels:
+            timing["total"] = t1 - t0
+            result = {"file": filepath, "error": "read audio fail", "timing": timing}
+            if Metrics.enabled():
+                result["metrics"] = Metrics.snapshot()
+            return result
+        audio.getFingerprints()
+        Cache.saveFingerprints(filehash, audio.fingerprints, channel_strategy)
+    else:
+        audio.fs = recConfig.audio_frame_rate
+        t1 = t0
+        timing["decode"] = 0.0
+    t2 = time.perf_counter()
+    timing["fingerprint"] = t2 - t1
+    if recConfig.early_exit:
+        result = audio.recognizeEarly()
+    else:
+        result = audio.recognize_s()
+    t3 = time.perf_counter()
+    timing["match"] = t3 - t2
+    timing["total"] = t3 - t0
+    result["file"] = filepath
+    result["timing"] = timing
+    if Metrics.enabled():
+        result["metrics"] = Metrics.snapshot()
+    return result
+
+
+_pool = None
+
+def getPool():
+    """获取识别使用的进程池, 进程池在第一次使用时创建并在之后的识别中复用
+
+    Returns
+    -------
+    multiprocessing.pool.Pool
+        recConfig.max_process_num 个工作进程组成的进程池
+    """
+    global _pool
+    if _pool is None:
+        _pool = multiprocessing.Pool(recConfig.max_process_num, initializer=_initWorker)
+    return _pool
+
+def closePool():
+    """关闭识别使用的进程池, 工作进程中的哈希缓存随之失效"""
+    global _pool
+    if _pool is not None:
+        _pool.terminate()
+        _pool.join()
+        _pool = None
+
+def _initWorker():
+    # 每个工作进程只建立一次自己的数据库连接
+    getMatcher()
+
+def _matchChunk(data):
+    hashes, offsets = data
+    # 工作进程的统计随结果返回, 由主进程合并
+    metrics = Metrics.enabled()
+    if metrics:
+        Metrics.reset()
+    song_ids, db_offsets, query_offsets = getMatcher().queryMatches(hashes, offsets)
+    return song_ids, db_offsets - query_offsets, Metrics.snapshot() if metrics else None
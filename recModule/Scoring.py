@@ -0,0 +1,120 @@
+from recModule import Metrics
+import numpy as np
+
+# 使用 bincount 统计时允许的最大直方图长度, 超过后退回 np.unique
+MAX_BINCOUNT_SIZE = 2 ** 20
+
+def scoreMatches(song_ids, deltas, topn=1):
+    """对匹配结果进行 offset 差值直方图统计\n
+
+    将 (song_id, delta) 打包成一个整数 key, 一次性统计每首歌曲每个 offset 差值出现的次数,
+    每首歌曲取直方图的峰值作为得分
+
+    Parameters
+    ----------
+    song_ids : NDArray
+        匹配到的歌曲 id
+    deltas : NDArray
+        对应的 offset 差值(数据库 offset - 查询样本 offset), 保留符号
+    topn : int, optional
+        返回得分最高的歌曲数量, by default 1
+
+    Returns
+    -------
+    Tuple[NDArray, NDArray, NDArray]
+        按得分降序排列的 song_id、峰值处的 delta 和峰值计数
+    """
+    with Metrics.timer("scoring"):
+        song_ids = np.asarray(song_ids, dtype=np.int64)
+        deltas = np.asarray(deltas, dtype=np.int64)
+        Metrics.count("matches", song_ids.size)
+        if song_ids.size == 0:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty
+
+        # 打包 key = song_id * span + (delta - min_delta)
+        min_delta = deltas.min()
+        span = int(deltas.max() - min_delta) + 1
+        min_song = song_ids.min()
+        keys = (song_ids - min_song) * span + (deltas - min_delta)
+        size = int(keys.max()) + 1
+        if size <= max(MAX_BINCOUNT_SIZE, 4 * keys.size):
+            counts = np.bincount(keys, minlength=size)
+            keys = np.flatnonzero(counts)
+            counts = counts[keys]
+        else:
+            keys, counts = np.unique(keys, return_counts=True)
+
+        # keys 已经有序, 按歌曲分组取直方图峰值
+        songs = keys // span
+        starts = np.flatnonzero(np.r_[True, songs[1:] != songs[:-1]])
+        peaks = np.maximum.reduceat(counts, starts)
+
+        # 按峰值计数降序取前 topn 首歌曲, 再在各自分组内定位峰值处的 delta
+        top = np.argsort(-peaks, kind="stable")[:topn]
+        ends = np.r_[starts[1:], keys.size]
+        best = np.array([starts[i] + np.argmax(counts[starts[i]:ends[i]]) for i in top], dtype=np.int64)
+        return (songs[best] + min_song,
+                keys[best] % span + min_delta,
+                counts[best])
+
+class MatchHistogram(object):
+    """增量统计的 offset 差值直方图\n
+
+    每次 add 一批匹配结果, 随时可以取出当前得分最高的歌曲, 用于提前结束识别.
+    直方图保存为有序的 key 数组和对应的计数数组, key = song_id << 32 | (delta + 2 ** 31),
+    合并和取峰值都是向量化的, 结果与对全部匹配调用 scoreMatches 相同
+    """
+
+    def __init__(self):
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+
+    def add(self, song_ids, deltas):
+        """加入一批匹配结果
+
+        Parameters
+        ----------
+        song_ids : NDArray
+            匹配到的歌曲 id
+        deltas : NDArray
+            对应的 offset 差值(数据库 offset - 查询样本 offset), 保留符号
+        """
+        song_ids = np.asarray(song_ids, dtype=np.int64)
+        Metrics.count("matches", song_ids.size)
+        if song_ids.size == 0:
+            return
+        with Metrics.timer("scoring"):
+            # 批内先合并相同的 (song_id, delta), 再合并到整体直方图
+            keys, counts = np.unique((song_ids << 32) + (np.asarray(deltas, dtype=np.int64) + 2 ** 31), return_counts=True)
+            pos = np.searchsorted(self.keys, keys)
+            found = pos < self.keys.size
+            found[found] = self.keys[pos[found]] == keys[found]
+            # keys 互不相同, pos[found] 也互不相同
+            self.counts[pos[found]] += counts[found]
+            new = ~found
+            if new.any():
+                self.keys = np.insert(self.keys, pos[new], keys[new])
+                self.counts = np.insert(self.counts, pos[new], counts[new])
+
+    def top(self, topn=1):
+        """当前得分最高的歌曲
+
+        Returns
+        -------
+        List[Tuple[int, int, int]]
+            按得分降序排列的 (song_id, 峰值处的 delta, 峰值计数)
+        """
+        if self.keys.size == 0:
+            return []
+        # keys 有序, 按歌曲分组取直方图峰值, 与 scoreMatches 相同
+        songs = self.keys >> 32
+        starts = np.flatnonzero(np.r_[True, songs[1:] != songs[:-1]])
+        peaks = np.maximum.reduceat(self.counts, starts)
+        ends = np.r_[starts[1:], self.keys.size]
+        result = []
+        for i in np.argsort(-peaks, kind="stable")[:topn].tolist():
+            best = starts[i] + int(np.argmax(self.counts[starts[i]:ends[i]]))
+            key = int(self.keys[best])
+            result.append((key >> 32, (key & 0xFFFFFFFF) - 2 ** 31, int(self.counts[best])))
+        return result
@@ -0,0 +1,310 @@
+from recModule.Config import recConfig
+from recModule import Model, Cache, Scoring, Storage, Metrics
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlsplit
+import os, json, time, asyncio, tempfile, bisect
+
+# 延迟直方图的桶上界(毫秒)
+LATENCY_BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+HTTP_STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+def fingerprintRequest(data=None, path=None, suffix=".mp3"):
+    """在进程池中为一个识别请求生成指纹\n
+
+    data 为上传的音频文件内容, 写入临时文件后解码; path 为服务器本地的音频文件, 按文件 sha256 使用指纹磁盘缓存.
+    上传的音频各不相同且没有淘汰机制, 不写入磁盘缓存
+
+    Returns
+    -------
+    Optional[Tuple[NDArray, NDArray, int, Optional[Dict]]]
+        指纹哈希、offset、采样频率和本次请求在工作进程中的统计(未开启 recConfig.metrics_enabled 时为 None),
+        读取失败时返回 None
+    """
+    metrics = Metrics.enabled()
+    if metrics:
+        Metrics.reset()
+    if path is not None:
+        audio = Model.Audio.initFromFile(path)
+        if not audio.prepareFingerprints(recConfig.channel_strategy):
+            return None
+        return audio.fingerprints["hash"], audio.fingerprints["offset"], audio.fs, Metrics.snapshot() if metrics else None
+    fd, tmp = tempfile.mkstemp(suffix=suffix)
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(data)
+        audio = Model.Audio(tmp, None, None)
+        audio.read(recConfig.channel_strategy)
+        if not audio.channels:
+            return None
+        audio.getFingerprints()
+        return audio.fingerprints["hash"], audio.fingerprints["offset"], audio.fs, Metrics.snapshot() if metrics else None
+    finally:
+        os.remove(tmp)
+
+
+def scoreRequest(matcher, hashes, offsets, postings, fs):
+    """将一个请求的指纹与查询到的 postings 展开为匹配行, 打分并生成识别结果(字段见 Model._buildResult)"""
+    song_ids, db_offsets, query_offsets = Storage.expandPostings(hashes, offsets, postings)
+    top_ids, top_deltas, top_counts = Scoring.scoreMatches(song_ids, db_offsets - query_offsets, recConfig.result_candidates)
+    return Model._buildResult(matcher, zip(top_ids.tolist(), top_deltas.tolist(), top_counts.tolist()), len(hashes), fs)
+
+
+class HashCoalescer(object):
+    """合并并发请求的哈希查询\n
+
+    同一时间窗口内各请求的哈希合并去重后通过一次 lookupFingerprints 查询,
+    已经在查询中的哈希直接等待该次查询的结果; 同时进行的查询数量不超过 connections
+
+    Parameters
+    ----------
+    matcher : Union[Index.MmapIndex, Storage.StorageBackend]
+        提供 lookupFingerprints 的查询对象
+    connections : int
+        同时进行的数据库查询数量上限
+    window : float
+        合并等待时间(秒)
+    batch_size : int
+        单次查询的哈希数量上限
+    """
+
+    def __init__(self, matcher, connections, window, batch_size):
+        self.matcher = matcher
+        self.window = window
+        self.batch_size = batch_size
+        self.semaphore = asyncio.Semaphore(connections)
+        self.executor = ThreadPoolExecutor(connections)
+        # 等待查询和正在查询的哈希 -> Future
+        self.pending = {}
+        self.queue = []
+        self.flush_handle = None
+        self.requested = 0
+        self.fetched = 0
+        self.round_trips = 0
+
+    async def lookup(self, hashes):
+        """查询一批哈希的 postings
+
+        Parameters
+        ----------
+        hashes : List
+            去重后的哈希
+
+        Returns
+        -------
+        Dict[Any, NDArray]
+            哈希到 (song_id, offset) 数组的映射(见 Storage.groupPostings), 不存在的哈希对应空数组
+        """
+        loop = asyncio.get_running_loop()
+        cache = Cache.getCache()
+        postings = {}
+        misses = cache.getMany(hashes, postings)
+        self.requested += len(misses)
+        futures = {}
+        for fingerprint in misses:
+            future = self.pending.get(fingerprint)
+            if future is None:
+                future = loop.create_future()
+                self.pending[fingerprint] = future
+                self.queue.append(fingerprint)
+            futures[fingerprint] = future
+        if len(self.queue) >= self.batch_size:
+            self._flush()
+        elif self.queue and self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.window, self._flush)
+        # gather 会取回全部 future 的异常, 查询失败时不会留下未取回的异常
+        postings.update(zip(futures.keys(), await asyncio.gather(*futures.values())))
+        return postings
+
+    def _flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        while self.queue:
+            batch, self.queue = self.queue[:self.batch_size], self.queue[self.batch_size:]
+            asyncio.ensure_future(self._fetch(batch))
+
+    async def _fetch(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            async with self.semaphore:
+                with Metrics.timer("db_lookup"):
+                    rows = await loop.run_in_executor(self.executor, self.matcher.lookupFingerprints, batch)
+            Metrics.count("db_queries")
+            Metrics.count("db_hashes", len(batch))
+            Metrics.count("db_rows", len(rows))
+            found = Storage.groupPostings(batch, rows)
+            self.round_trips += 1
+            self.fetched += len(batch)
+            Cache.getCache().putMany(found)
+        except Exception as err:
+            for fingerprint in batch:
+                future = self.pending.pop(fingerprint)
+                if not future.done():
+                    future.set_exception(err)
+            return
+        for fingerprint in batch:
+            future = self.pending.pop(fingerprint)
+            if not future.done():
+                future.set_result(found[fingerprint])
+
+
+class ServerMetrics(object):
+    """请求数、吞吐量和延迟直方图"""
+
+    def __init__(self):
+        self.start = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.stages = {"fingerprint": 0.0, "match": 0.0, "total": 0.0}
+
+    def observe(self, timing):
+        self.requests += 1
+        for stage, seconds in timing.items():
+            self.stages[stage] += seconds
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, timing["total"] * 1000)] += 1
+
+    def snapshot(self, coalescer=None):
+        elapsed = time.time() - self.start
+        buckets = {"le_%d" % bound: count for bound, count in zip(LATENCY_BUCKETS, self.buckets)}
+        buckets["le_inf"] = self.buckets[-1]
+        return {"uptime": elapsed,
+                "requests": self.requests,
+                "errors": self.errors,
+                "requests_per_sec": self.requests / elapsed if elapsed > 0 else 0.0,
+                "latency_ms": buckets,
+                "stage_mean": {stage: total / self.requests if self.requests else 0.0 for stage, total in self.stages.items()},
+                "coalescing": {"hashes_requested": coalescer.requested if coalescer else 0,
+                               "hashes_fetched": coalescer.fetched if coalescer else 0,
+                               "round_trips": coalescer.round_trips if coalescer else 0},
+                "hash_cache": Cache.getCache().stats(),
+                # 开启 recConfig.metrics_enabled 时各阶段(含工作进程中的解码和指纹生成)的耗时和计数
+                "stages": Metrics.snapshot()}
+
+
+class RecognitionServer(object):
+    """asyncio 识别服务\n
+
+    POST /recognize 请求体为音频文件内容, 或 JSON {"path": 服务器本地音频文件路径}, 返回识别结果 JSON;
+    GET /metrics 返回吞吐量、延迟直方图和查询合并统计.
+    指纹在进程池中生成, 数据库查询经过 HashCoalescer 合并
+    """
+
+    def __init__(self, workers=None, connections=None):
+        self.matcher = Model.getMatcher()
+        workers = workers or recConfig.max_process_num
+        self.pool = ProcessPoolExecutor(workers)
+        # 进程池按需 fork 工作进程, 在接受连接之前全部启动, 否则工作进程会继承已打开的连接, 关闭后客户端收不到 EOF
+        for future in [self.pool.submit(int) for _ in range(workers)]:
+            future.result()
+        self.coalescer = None
+        self.connections = connections or recConfig.server_db_connections
+        self.metrics = ServerMetrics()
+
+    async def recognize(self, data=None, path=None, suffix=".mp3"):
+        """识别一个音频, 返回识别结果(字段见 Model._buildResult), 另有各阶段耗时 timing"""
+        loop = asyncio.get_running_loop()
+        # 在事件循环中创建, 旧版本 asyncio 的 Semaphore 会绑定创建时的事件循环
+        if self.coalescer is None:
+            self.coalescer = HashCoalescer(self.matcher, self.connections, recConfig.server_coalesce_ms / 1000, recConfig.query_batch_size)
+        t0 = time.perf_counter()
+        fingerprints = await loop.run_in_executor(self.pool, fingerprintRequest, data, path, suffix)
+        if fingerprints is None:
+            raise ValueError("read audio fail")
+        hashes, offsets, fs, metrics = fingerprints
+        Metrics.merge(metrics)
+        t1 = time.perf_counter()
+
+        hash_list = hashes.tolist()
+        postings = await self.coalescer.lookup(list(dict.fromkeys(hash_list)))
+        # 展开匹配和打分在线程中进行, 不阻塞事件循环中的其他请求
+        result = await loop.run_in_executor(self.coalescer.executor, scoreRequest, self.matcher, hash_list, offsets, postings, fs)
+        t2 = time.perf_counter()
+        result["timing"] = {"fingerprint": t1 - t0, "match": t2 - t1, "total": t2 - t0}
+        self.metrics.observe(result["timing"])
+        return result
+
+    async def handle(self, reader, writer):
+        """处理一个 HTTP/1.1 连接, 每个连接处理一个请求"""
+        try:
+            status, body = await self._dispatch(reader)
+        except Exception as err:
+            self.metrics.errors += 1
+            status, body = 500, {"error": str(err)}
+        payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        writer.write(("HTTP/1.1 %d %s\r\nContent-Type: application/json; charset=utf-8\r\nContent-Length: %d\r\nConnection: close\r\n\r\n"
+                      % (status, HTTP_STATUS[status], len(payload))).encode("latin-1") + payload)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _dispatch(self, reader):
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        if not request_line:
+            return 400, {"error": "empty request"}
+        method, target, _ = request_line.split(" ", 2)
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        data = await reader.readexactly(int(headers.get("content-length", 0)))
+
+        path = urlsplit(target).path
+        if path == "/metrics":
+            return 200, self.metrics.snapshot(self.coalescer)
+        if path != "/recognize":
+            return 404, {"error": "unknown path %s" % path}
+        if method != "POST":
+            return 405, {"error": "use POST"}
+        try:
+            if headers.get("content-type", "").startswith("application/json"):
+                return 200, await self.recognize(path=json.loads(data)["path"])
+            return 200, await self.recognize(data=data, suffix=headers.get("x-audio-suffix", ".mp3"))
+        except FileNotFoundError as err:
+            self.metrics.errors += 1
+            return 404, {"error": str(err)}
+        except (ValueError, KeyError, OSError) as err:
+            self.metrics.errors += 1
+            return 400, {"error": str(err)}
+
+    async def serve(self, host=None, port=None, unix_path=None):
+        """监听 TCP 端口或 Unix 套接字直到被取消"""
+        if unix_path:
+            server = await asyncio.start_unix_server(self.handle, path=unix_path)
+        else:
+            server = await asyncio.start_server(self.handle, host or recConfig.server_host, port or recConfig.server_port)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.pool.shutdown()
+        if self.coalescer is not None:
+            self.coalescer.executor.shutdown()
+
+
+def serve(host=None, port=None, unix_path=None, workers=None):
+    """启动识别服务
+
+    Parameters
+    ----------
+    host : str, optional
+        监听地址, None 时使用 recConfig.server_host, by default None
+    port : int, optional
+        监听端口, None 时使用 recConfig.server_port, by default None
+    unix_path : str, optional
+        Unix 套接字路径, 给出时不监听 TCP 端口, by default None
+    workers : int, optional
+        生成指纹的进程数量, None 时使用 recConfig.max_process_num, by default None
+    """
+    server = RecognitionServer(workers)
+    try:
+        asyncio.run(server.serve(host, port, unix_path))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
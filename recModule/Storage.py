@@ -0,0 +1,536 @@
+from recModule import Database, Cache, Metrics
+from recModule.Config import recConfig
+from recModule.Fingerprint import FPconfig
+import os, sqlite3, threading
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+class StorageBackend(object):
+    """指纹存储后端接口\n
+
+    Audio 只通过该接口读写歌曲和指纹, 具体实现可以是 SQLAlchemy 连接的数据库服务器, 也可以是本地嵌入式数据库
+    """
+
+    def checkDatabase(self):
+        """检查数据库, 返回值与 Database.checkDatabase 相同"""
+        raise NotImplementedError
+
+    def createTables(self):
+        """创建数据表并记录 hash_mode"""
+        raise NotImplementedError
+
+    def getSong(self, filehash):
+        """根据 filehash 获取歌曲, 返回 (id, name, fingerprinted), 不存在时返回 None"""
+        raise NotImplementedError
+
+    def addSong(self, name, filehash):
+        """添加歌曲并返回歌曲 id"""
+        raise NotImplementedError
+
+    def setFingerprinted(self, song_id):
+        """标记歌曲已经完成指纹导入"""
+        raise NotImplementedError
+
+    def insertFingerprints(self, song_id, fingerprints):
+        """批量导入以 ("hash", "offset") 为字段的结构化数组"""
+        raise NotImplementedError
+
+    def lookupFingerprints(self, hashes):
+        """查询一批哈希, 返回 (song_id, fingerprint, offset) 行"""
+        raise NotImplementedError
+
+    def querySongNames(self, song_ids):
+        """通过一次查询获取多个歌曲的名字, 返回 song_id 到歌曲名的映射"""
+        raise NotImplementedError
+
+    def exportFingerprints(self, batch_size=recConfig.insert_number):
+        """分批导出全部指纹, 每批为 (song_id, fingerprint, offset) 行"""
+        raise NotImplementedError
+
+    def exportSongs(self):
+        """导出已经完成指纹导入的歌曲, 返回 song_id 到歌曲名的映射"""
+        raise NotImplementedError
+
+    def dropFingerprintIndex(self):
+        """删除指纹索引, 大量导入前调用"""
+        raise NotImplementedError
+
+    def createFingerprintIndex(self):
+        """重建指纹索引, 大量导入后调用"""
+        raise NotImplementedError
+
+    def queryMatches(self, hashes, offsets, batch_size=recConfig.query_batch_size):
+        """批量查询匹配的指纹\n
+
+        将待查询的指纹去重后先查询哈希缓存, 未命中的按 batch_size 分批调用 lookupFingerprints 并写入缓存,
+        再根据哈希展开为 (song_id, db_offset, query_offset) 匹配行
+
+        Parameters
+        ----------
+        hashes : NDArray
+            待查询的指纹哈希
+        offsets : NDArray
+            指纹在查询样本中的 offset
+        batch_size : int, optional
+            单次查询的指纹数量, by default recConfig.query_batch_size
+
+        Returns
+        -------
+        Tuple[NDArray, NDArray, NDArray]
+            song_id、数据库中的 offset 和查询样本中的 offset 三个等长数组
+        """
+        # 同一个哈希可能在查询样本中出现多次, 只查询一次
+        hash_list = np.asarray(hashes).tolist()
+        unique = list(dict.fromkeys(hash_list))
+
+        cache = Cache.getCache()
+        postings = {}
+        misses = cache.getMany(unique, postings)
+        Metrics.count("cache_hits", len(unique) - len(misses))
+        for st in range(0, len(misses), batch_size):
+            batch = misses[st:st + batch_size]
+            with Metrics.timer("db_lookup"):
+                rows = self.lookupFingerprints(batch)
+            Metrics.count("db_queries")
+            Metrics.count("db_hashes", len(batch))
+            Metrics.count("db_rows", len(rows))
+            # 数据库中不存在的哈希也写入缓存, 避免重复查询
+            found = groupPostings(batch, rows)
+            cache.putMany(found)
+            postings.update(found)
+
+        return expandPostings(hash_list, offsets, postings)
+
+
+class SQLAlchemyBackend(StorageBackend):
+    """通过 SQLAlchemy 连接的数据库(默认 MySQL)"""
+
+    def __init__(self, conn=recConfig.sqlalchemy_address):
+        self.conn = conn
+        self.db, self.engine = Database.initSession(conn)
+
+    def checkDatabase(self):
+        return Database.checkDatabase(self.conn)
+
+    def createTables(self):
+        return Database.createTables(self.conn)
+
+    def getSong(self, filehash):
+        dbs = self.db()
+        try:
+            song = dbs.query(Database.Songs).filter_by(filehash=filehash).first()
+            if song is None:
+                return None
+            return song.id, song.name, bool(song.fingerprinted)
+        finally:
+            dbs.close()
+
+    def addSong(self, name, filehash):
+        dbs = self.db()
+        try:
+            song = Database.Songs(name=name, filehash=filehash)
+            dbs.add(song)
+            dbs.commit()
+            return song.id
+        finally:
+            dbs.close()
+
+    def setFingerprinted(self, song_id):
+        dbs = self.db()
+        try:
+            dbs.query(Database.Songs).filter_by(id=song_id).update({"fingerprinted": True})
+            dbs.commit()
+        finally:
+            dbs.close()
+
+    def insertFingerprints(self, song_id, fingerprints):
+        Database.bulkInsertFingerprints(self.engine, song_id, fingerprints)
+
+    def lookupFingerprints(self, hashes):
+        dbs = self.db()
+        try:
+            return dbs.query(Database.Fingerprints.song_id, Database.Fingerprints.fingerprint, Database.Fingerprints.offset) \
+                .filter(Database.Fingerprints.fingerprint.in_(hashes)).all()
+        finally:
+            dbs.close()
+
+    def querySongNames(self, song_ids):
+        song_ids = [int(song_id) for song_id in set(song_ids)]
+        if not song_ids:
+            return {}
+        dbs = self.db()
+        try:
+            result = dbs.query(Database.Songs.id, Database.Songs.name).filter(Database.Songs.id.in_(song_ids)).all()
+            return {song_id: name for song_id, name in result}
+        finally:
+            dbs.close()
+
+    def exportFingerprints(self, batch_size=recConfig.insert_number):
+        dbs = self.db()
+        try:
+            query = dbs.query(Database.Fingerprints.song_id, Database.Fingerprints.fingerprint, Database.Fingerprints.offset).yield_per(batch_size)
+            rows = []
+            for row in query:
+                rows.append(row)
+                if len(rows) >= batch_size:
+                    yield rows
+                    rows = []
+            if rows:
+                yield rows
+        finally:
+            dbs.close()
+
+    def exportSongs(self):
+        dbs = self.db()
+        try:
+            return {song_id: name for song_id, name in dbs.query(Database.Songs.id, Database.Songs.name).filter_by(fingerprinted=True).all()}
+        finally:
+            dbs.close()
+
+    def dropFingerprintIndex(self):
+        Database.dropFingerprintIndex(self.engine)
+
+    def createFingerprintIndex(self):
+        Database.createFingerprintIndex(self.engine)
+
+
+# SQLite 3.32 之前单条语句最多绑定 999 个参数, 大于该值的 IN 查询需要分块
+SQLITE_MAX_VARIABLES = 999
+
+class SQLiteBackend(StorageBackend):
+    """嵌入式 SQLite 数据库(WAL 模式)\n
+
+    不需要数据库服务器, 表结构与 SQLAlchemy 后端相同, 用于边缘设备识别和 CI 基准测试
+    """
+
+    def __init__(self, path=recConfig.sqlite_path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+        return self._conn
+
+    def checkDatabase(self):
+        try:
+            with self.lock:
+                tables = {row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+                missing = [table for table in ("Songs", "Fingerprints") if table not in tables]
+                if missing:
+                    return (False, "no_tables", "missing tables: %s" % ", ".join(missing))
+                row = None
+                if "Configs" in tables:
+                    row = self.conn.execute("SELECT value FROM Configs WHERE name='hash_mode'").fetchone()
+        except sqlite3.Error as err:
+            return (False, type(err).__name__, err)
+        # 没有 Configs 表的旧数据库按 sha256 处理
+        hash_mode = row[0] if row is not None else Database.LEGACY_HASH_MODE
+        if hash_mode != FPconfig.hash_mode:
+            return (False, "hash_mode", "database is built with hash mode %s but FPconfig.hash_mode is %s" % (hash_mode, FPconfig.hash_mode))
+        return (True, 0, "")
+
+    def createTables(self):
+        fingerprint_type = "VARCHAR(64)" if FPconfig.hash_mode == "sha256" else "INTEGER"
+        try:
+            with self.lock, self.conn:
+                self.conn.execute("CREATE TABLE IF NOT EXISTS Songs (id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR(64), filehash VARCHAR(512), fingerprinted BOOLEAN DEFAULT 0)")
+                self.conn.execute("CREATE INDEX IF NOT EXISTS ix_Songs_filehash ON Songs (filehash)")
+                self.conn.execute('CREATE TABLE IF NOT EXISTS Fingerprints (id INTEGER PRIMARY KEY, song_id INTEGER, fingerprint %s, "offset" INTEGER)' % fingerprint_type)
+                self.conn.execute("CREATE INDEX IF NOT EXISTS ix_Fingerprints_fingerprint ON Fingerprints (fingerprint)")
+                self.conn.execute("CREATE TABLE IF NOT EXISTS Configs (name VARCHAR(64) PRIMARY KEY, value VARCHAR(64))")
+                self.conn.execute("INSERT OR IGNORE INTO Configs (name, value) VALUES ('hash_mode', ?)", (FPconfig.hash_mode,))
+            return True
+        except sqlite3.Error:
+            return False
+
+    def getSong(self, filehash):
+        with self.lock:
+            row = self.conn.execute("SELECT id, name, fingerprinted FROM Songs WHERE filehash = ?", (filehash,)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], bool(row[2])
+
+    def addSong(self, name, filehash):
+        with self.lock, self.conn:
+            return self.conn.execute("INSERT INTO Songs (name, filehash, fingerprinted) VALUES (?, ?, 0)", (name, filehash)).lastrowid
+
+    def setFingerprinted(self, song_id):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE Songs SET fingerprinted = 1 WHERE id = ?", (song_id,))
+
+    def insertFingerprints(self, song_id, fingerprints):
+        if len(fingerprints) == 0:
+            return
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT INTO Fingerprints (song_id, fingerprint, "offset") VALUES (?, ?, ?)',
+                                  ((song_id, fingerprint, offset) for fingerprint, offset in zip(fingerprints["hash"].tolist(), fingerprints["offset"].tolist())))
+
+    def _selectIn(self, sql, values):
+        """执行含一个 IN (%s) 的查询, 参数按 SQLITE_MAX_VARIABLES 分块绑定后合并结果"""
+        rows = []
+        with self.lock:
+            for st in range(0, len(values), SQLITE_MAX_VARIABLES):
+                part = values[st:st + SQLITE_MAX_VARIABLES]
+                rows.extend(self.conn.execute(sql % ",".join("?" * len(part)), part).fetchall())
+        return rows
+
+    def lookupFingerprints(self, hashes):
+        return self._selectIn('SELECT song_id, fingerprint, "offset" FROM Fingerprints WHERE fingerprint IN (%s)', list(hashes))
+
+    def querySongNames(self, song_ids):
+        song_ids = [int(song_id) for song_id in set(song_ids)]
+        if not song_ids:
+            return {}
+        return {song_id: name for song_id, name in self._selectIn("SELECT id, name FROM Songs WHERE id IN (%s)", song_ids)}
+
+    def exportFingerprints(self, batch_size=recConfig.insert_number):
+        # 使用独立的连接导出, 不阻塞其他查询
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            cursor = conn.execute('SELECT song_id, fingerprint, "offset" FROM Fingerprints')
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            conn.close()
+
+    def exportSongs(self):
+        with self.lock:
+            return {song_id: name for song_id, name in self.conn.execute("SELECT id, name FROM Songs WHERE fingerprinted = 1")}
+
+    def dropFingerprintIndex(self):
+        with self.lock, self.conn:
+            self.conn.execute("DROP INDEX IF EXISTS ix_Fingerprints_fingerprint")
+
+    def createFingerprintIndex(self):
+        with self.lock, self.conn:
+            self.conn.execute("CREATE INDEX IF NOT EXISTS ix_Fingerprints_fingerprint ON Fingerprints (fingerprint)")
+
+
+# 没有匹配的哈希对应的 postings
+EMPTY_POSTINGS = np.empty((0, 2), dtype=np.int64)
+EMPTY_POSTINGS.flags.writeable = False
+
+def groupPostings(hashes, rows):
+    """将 lookupFingerprints 返回的行按哈希分组
+
+    Parameters
+    ----------
+    hashes : List
+        本次查询的哈希
+    rows : List[Tuple[int, Any, int]]
+        (song_id, fingerprint, offset) 行
+
+    Returns
+    -------
+    Dict[Any, NDArray]
+        哈希到形状 (n, 2) 的 int64 数组 (song_id, offset) 的映射, 没有匹配的哈希对应空数组
+    """
+    if not rows:
+        return {fingerprint: EMPTY_POSTINGS for fingerprint in hashes}
+    position = {fingerprint: i for i, fingerprint in enumerate(hashes)}
+    index = np.fromiter(map(position.__getitem__, map(itemgetter(1), rows)), dtype=np.int64, count=len(rows))
+    postings = np.empty((len(rows), 2), dtype=np.int64)
+    postings[:, 0] = np.fromiter(map(itemgetter(0), rows), dtype=np.int64, count=len(rows))
+    postings[:, 1] = np.fromiter(map(itemgetter(2), rows), dtype=np.int64, count=len(rows))
+    # 按哈希排序后切分, 每个哈希的 postings 是连续的一段
+    postings = postings[np.argsort(index, kind="stable")]
+    ends = np.cumsum(np.bincount(index, minlength=len(hashes))).tolist()
+    return {fingerprint: postings[st:end] for fingerprint, st, end in zip(hashes, [0] + ends[:-1], ends)}
+
+def expandPostings(hashes, offsets, postings):
+    """将查询样本的每个指纹与其哈希的全部 postings 组合为匹配行
+
+    每个查询指纹只做一次字典查找, 匹配行由 np.concatenate 和 np.repeat 生成
+
+    Parameters
+    ----------
+    hashes : List
+        查询样本的指纹哈希, 可以重复
+    offsets : NDArray
+        指纹在查询样本中的 offset
+    postings : Dict[Any, NDArray]
+        哈希到 groupPostings 生成的数组的映射, 必须包含 hashes 中的每个哈希
+
+    Returns
+    -------
+    Tuple[NDArray, NDArray, NDArray]
+        song_id、数据库中的 offset 和查询样本中的 offset 三个等长数组
+    """
+    parts = [postings[fingerprint] for fingerprint in hashes]
+    if not parts:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    counts = np.fromiter(map(len, parts), dtype=np.int64, count=len(parts))
+    rows = np.concatenate(parts)
+    return (np.ascontiguousarray(rows[:, 0]),
+            np.ascontiguousarray(rows[:, 1]),
+            np.repeat(np.asarray(offsets, dtype=np.int64), counts))
+
+def shardOf(hashes, shards):
+    """计算指纹哈希所在的分片\n
+
+    sha256 模式按十六进制哈希的前 4 位分片; 整数哈希模式下高位是频率, 分布不均匀, 按整数取模分片.
+    分片数量改变后已有数据的位置随之改变, 需要重新导入
+
+    Parameters
+    ----------
+    hashes : Union[NDArray, List]
+        指纹哈希
+    shards : int
+        分片数量
+
+    Returns
+    -------
+    NDArray
+        每个哈希所在分片的下标
+    """
+    hashes = np.asarray(hashes)
+    if hashes.size == 0:
+        return np.empty(0, dtype=np.int64)
+    if hashes.dtype.kind == "U":
+        # 前 4 个字符的 unicode 码位, 统一为小写后转换为十六进制数值
+        codes = hashes.astype("U4").view(np.uint32).reshape(-1, 4).astype(np.int64) | 0x20
+        values = np.where(codes <= ord("9"), codes - ord("0"), codes - ord("a") + 10)
+        prefix = (values[:, 0] << 12) | (values[:, 1] << 8) | (values[:, 2] << 4) | values[:, 3]
+        return prefix % shards
+    return hashes.astype(np.int64) % shards
+
+
+class ShardedBackend(StorageBackend):
+    """按指纹哈希前缀分片的存储后端\n
+
+    每个分片是一个独立的 SQLAlchemy 数据库或 SQLite 文件, 歌曲信息只保存在第一个分片中;
+    导入时按 shardOf 将指纹写入对应的分片, 查询时并行查询所有分片后合并匹配结果
+
+    Parameters
+    ----------
+    shards : List[str]
+        分片列表, 含 "://" 的作为 SQLAlchemy 连接, 否则作为 SQLite 文件路径
+    """
+
+    def __init__(self, shards=recConfig.storage_shards):
+        if not shards:
+            raise ValueError("recConfig.storage_shards is empty")
+        self.shards = [SQLAlchemyBackend(shard) if "://" in shard else SQLiteBackend(shard) for shard in shards]
+        self.primary = self.shards[0]
+        self.executor = ThreadPoolExecutor(len(self.shards))
+
+    def _scatter(self, func, items):
+        """对每个分片并行调用 func(shard, item), 返回结果列表"""
+        return list(self.executor.map(func, self.shards, items))
+
+    def checkDatabase(self):
+        for i, status in enumerate(self._scatter(lambda shard, _: shard.checkDatabase(), range(len(self.shards)))):
+            if not status[0]:
+                return (False, status[1], "shard %d: %s" % (i, status[2]))
+        return (True, 0, "")
+
+    def createTables(self):
+        return all(self._scatter(lambda shard, _: shard.createTables(), range(len(self.shards))))
+
+    def getSong(self, filehash):
+        return self.primary.getSong(filehash)
+
+    def addSong(self, name, filehash):
+        return self.primary.addSong(name, filehash)
+
+    def setFingerprinted(self, song_id):
+        self.primary.setFingerprinted(song_id)
+
+    def insertFingerprints(self, song_id, fingerprints):
+        index = shardOf(fingerprints["hash"], len(self.shards))
+        self._scatter(lambda shard, i: shard.insertFingerprints(song_id, fingerprints[index == i]), range(len(self.shards)))
+
+    def lookupFingerprints(self, hashes):
+        hashes = list(hashes)
+        index = shardOf(hashes, len(self.shards))
+        parts = [[fingerprint for fingerprint, j in zip(hashes, index.tolist()) if j == i] for i in range(len(self.shards))]
+        rows = []
+        for part in self._scatter(lambda shard, part: shard.lookupFingerprints(part) if part else [], parts):
+            rows.extend(part)
+        return rows
+
+    def queryMatches(self, hashes, offsets, batch_size=recConfig.query_batch_size):
+        # 每个分片各自分批查询自己的哈希, 合并后的 (song_id, delta) 与单库完全相同
+        hashes, offsets = np.asarray(hashes), np.asarray(offsets)
+        index = shardOf(hashes, len(self.shards))
+        results = self._scatter(lambda shard, i: shard.queryMatches(hashes[index == i], offsets[index == i], batch_size), range(len(self.shards)))
+        return tuple(np.concatenate([result[k] for result in results]) for k in range(3))
+
+    def querySongNames(self, song_ids):
+        return self.primary.querySongNames(song_ids)
+
+    def exportFingerprints(self, batch_size=recConfig.insert_number):
+        for shard in self.shards:
+            for rows in shard.exportFingerprints(batch_size):
+                yield rows
+
+    def exportSongs(self):
+        return self.primary.exportSongs()
+
+    def dropFingerprintIndex(self):
+        self._scatter(lambda shard, _: shard.dropFingerprintIndex(), range(len(self.shards)))
+
+    def createFingerprintIndex(self):
+        self._scatter(lambda shard, _: shard.createFingerprintIndex(), range(len(self.shards)))
+
+
+_storage = None
+_storage_pid = None
+
+def createStorage(backend=None):
+    """创建存储后端
+
+    Parameters
+    ----------
+    backend : str, optional
+        后端名称, None 时使用 recConfig.storage_backend, by default None
+
+    Returns
+    -------
+    StorageBackend
+        新创建的存储后端
+    """
+    backend = backend or recConfig.storage_backend
+    if backend == "sqlite":
+        return SQLiteBackend(recConfig.sqlite_path)
+    if backend == "sqlalchemy":
+        return SQLAlchemyBackend(recConfig.sqlalchemy_address)
+    if backend == "sharded":
+        return ShardedBackend(recConfig.storage_shards)
+    raise ValueError("Unknown storage backend: %s" % backend)
+
+def getStorage():
+    """获取当前进程共享的存储后端, 子进程中会重新创建连接
+
+    Returns
+    -------
+    StorageBackend
+        recConfig.storage_backend 对应的存储后端
+    """
+    global _storage, _storage_pid
+    if _storage is None or _storage_pid != os.getpid():
+        _storage = createStorage()
+        _storage_pid = os.getpid()
+    return _storage
+
+def setStorage(storage):
+    """替换当前进程共享的存储后端, 例如基准测试中切换到不同的数据库
+
+    Parameters
+    ----------
+    storage : StorageBackend
+        新的存储后端
+    """
+    global _storage, _storage_pid
+    _storage = storage
+    _storage_pid = os.getpid()
@@ -14,6 +14,17 @@ def recognize(args):
     else:
         Console.log("File does not exist: %s" % filepath)
 
+def recognize_stream(args):
+    # "-" 表示从标准输入读取 PCM
+    if args.strip() == "-":
+        Console.recognizeStream("-")
+        return
+    filepath = parsePath(args)
+    if os.path.exists(filepath):
+        Console.recognizeStream(filepath)
+    else:
+        Console.log("File does not exist: %s" % filepath)
+
 def add_audio(args):
     filepath = parsePath(args)
     if os.path.exists(filepath):
@@ -26,4 +37,14 @@ def add_dir(args):
     if os.path.exists(dirpath):
         Console.addAudioFromDir(dirpath)
     else:
-        Console.log("File does not exist: %s" % dirpath)
\ No newline at end of file
+        Console.log("File does not exist: %s" % dirpath)
+
+def compile_index(args):
+    Console.compileIndex(parsePath(args))
+
+def recognize_dir(args, jobs=None, out=None):
+    dirpath = parsePath(args)
+    if os.path.exists(dirpath):
+        return Console.recognizeDir(dirpath, jobs, out)
+    else:
+        Console.log("File does not exist: %s" % dirpath)
@@ -0,0 +1,240 @@
+"""指纹导入基准测试
+
+生成可复现的合成音频语料(音阶、扫频、噪声, 以及 song/ 和 sample/ 中音频片段的混合),
+逐个文件统计 decode、specgram、peaks、hashing、insert 各阶段耗时, 结果写入 JSON, 用于对比不同提交的性能.
+
+    python test/benchIngest.py --out ingest.json
+    python test/benchIngest.py --files 40 --seconds 60 --out ingest.json
+    python test/benchIngest.py --baseline ingest.json
+"""
+import os, sys, json, time, wave, argparse, platform, subprocess, tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+from recModule.Config import recConfig
+from recModule.Fingerprint import FPconfig
+from recModule import AudioDecoder, Fingerprint, Storage
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+STAGES = ["decode", "specgram", "peaks", "hashing", "insert"]
+
+def writeWav(path, samples, fs=recConfig.audio_frame_rate):
+    """将 [-1, 1] 范围的单声道浮点采样写为 16 位 WAV 文件"""
+    data = (np.clip(samples, -1, 1) * 32767).astype("<i2")
+    with wave.open(path, "wb") as fh:
+        fh.setnchannels(1)
+        fh.setsampwidth(2)
+        fh.setframerate(fs)
+        fh.writeframes(data.tobytes())
+
+def makeTones(rng, seconds, fs):
+    """随机音符序列, 每个音符带两个泛音和衰减包络"""
+    samples = np.zeros(int(seconds * fs), dtype=np.float64)
+    pos = 0
+    while pos < samples.size:
+        length = min(int(rng.uniform(0.15, 0.6) * fs), samples.size - pos)
+        freq = 440.0 * 2 ** ((rng.integers(-24, 25)) / 12)
+        t = np.arange(length) / fs
+        note = sum(np.sin(2 * np.pi * freq * k * t) / k for k in (1, 2, 3))
+        samples[pos:pos + length] = 0.3 * note * np.exp(-3 * t)
+        pos += length
+    return samples
+
+def makeChirps(rng, seconds, fs):
+    """首尾频率随机的对数扫频"""
+    samples = np.zeros(int(seconds * fs), dtype=np.float64)
+    step = int(rng.uniform(1, 3) * fs)
+    for pos in range(0, samples.size, step):
+        length = min(step, samples.size - pos)
+        f0, f1 = rng.uniform(100, 8000, 2)
+        t = np.arange(length) / fs
+        duration = length / fs
+        k = (f1 / f0) ** (1 / duration)
+        samples[pos:pos + length] = 0.5 * np.sin(2 * np.pi * f0 * (k ** t - 1) / np.log(k))
+    return samples
+
+def makeNoise(rng, seconds, fs):
+    """白噪声和粉红噪声交替"""
+    white = rng.standard_normal(int(seconds * fs))
+    spectrum = np.fft.rfft(white)
+    spectrum[1:] /= np.sqrt(np.arange(1, spectrum.size))
+    pink = np.fft.irfft(spectrum, white.size)
+    mask = (np.arange(white.size) // fs) % 2 == 0
+    samples = np.where(mask, white / np.abs(white).max(), pink / np.abs(pink).max())
+    return 0.5 * samples
+
+def loadSources():
+    """song/ 和 sample/ 中的参考音频, 解码为 [-1, 1] 的单声道浮点数组"""
+    sources = []
+    for folder in ("song", "sample"):
+        for filepath in sorted(AudioDecoder.listDir(os.path.join(ROOT, folder))):
+            fs, channels = AudioDecoder.read(filepath, "mono_mix")
+            if channels:
+                sources.append(channels[0].astype(np.float64) / 32768)
+    return sources
+
+def makeMix(rng, seconds, fs, sources):
+    """随机截取两段参考音频, 按随机增益混合并叠加少量噪声"""
+    length = int(seconds * fs)
+    samples = 0.01 * rng.standard_normal(length)
+    for _ in range(2):
+        source = sources[rng.integers(len(sources))]
+        if source.size > length:
+            st = rng.integers(source.size - length)
+            source = source[st:st + length]
+        samples[:source.size] += rng.uniform(0.3, 0.8) * source
+    return samples
+
+def generateCorpus(corpus, files, seconds, seed, fs=recConfig.audio_frame_rate):
+    """生成合成语料, 相同的参数和种子总是得到相同的文件
+
+    Returns
+    -------
+    List[Tuple[str, str]]
+        (文件路径, 类别)
+    """
+    os.makedirs(corpus, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    sources = loadSources()
+    kinds = ["tones", "chirps", "noise"] + (["mix"] if sources else [])
+    generated = []
+    for i in range(files):
+        kind = kinds[i % len(kinds)]
+        path = os.path.join(corpus, "%s_%03d.wav" % (kind, i))
+        if kind == "tones":
+            samples = makeTones(rng, seconds, fs)
+        elif kind == "chirps":
+            samples = makeChirps(rng, seconds, fs)
+        elif kind == "noise":
+            samples = makeNoise(rng, seconds, fs)
+        else:
+            samples = makeMix(rng, seconds, fs, sources)
+        writeWav(path, samples, fs)
+        generated.append((path, kind))
+    return generated
+
+def ingestFile(storage, filepath):
+    """按阶段导入一个文件并计时
+
+    Returns
+    -------
+    Dict[str, Any]
+        各阶段耗时、音频长度、解码后的字节数、峰值数、指纹数
+    """
+    timing = {}
+    t = time.perf_counter()
+    fs, channels = AudioDecoder.read(filepath, recConfig.channel_strategy)
+    timing["decode"] = time.perf_counter() - t
+    if not channels:
+        return None
+
+    hashes, offsets, peaks_num = [], [], 0
+    timing["specgram"] = timing["peaks"] = timing["hashing"] = 0.0
+    for channel in channels:
+        t = time.perf_counter()
+        arr = Fingerprint.getSpecgramArr(channel, fs)
+        timing["specgram"] += time.perf_counter() - t
+        t = time.perf_counter()
+        peaks = Fingerprint.getConstellationMap(arr)
+        timing["peaks"] += time.perf_counter() - t
+        peaks_num += len(peaks)
+        t = time.perf_counter()
+        h, o = Fingerprint.getFBHashArray(peaks)
+        hashes.append(h)
+        offsets.append(o)
+        timing["hashing"] += time.perf_counter() - t
+    t = time.perf_counter()
+    fingerprints = Fingerprint.uniqueFingerprints(np.concatenate(hashes), np.concatenate(offsets))
+    timing["hashing"] += time.perf_counter() - t
+
+    t = time.perf_counter()
+    song_id = storage.addSong(os.path.splitext(os.path.basename(filepath))[0], AudioDecoder.generateFilehash(filepath))
+    storage.insertFingerprints(song_id, fingerprints)
+    storage.setFingerprinted(song_id)
+    timing["insert"] = time.perf_counter() - t
+
+    samples = sum(len(channel) for channel in channels)
+    return {"seconds": len(channels[0]) / fs,
+            "decoded_mb": samples * 2 / 2 ** 20,
+            "file_mb": os.path.getsize(filepath) / 2 ** 20,
+            "peaks": peaks_num,
+            "fingerprints": len(fingerprints),
+            "timing": timing}
+
+def gitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+def summarize(results):
+    """汇总各阶段总耗时、每 MB 解码数据和每分钟音频的耗时"""
+    seconds = sum(r["seconds"] for r in results)
+    decoded_mb = sum(r["decoded_mb"] for r in results)
+    total = {stage: sum(r["timing"][stage] for r in results) for stage in STAGES}
+    wall = sum(total.values())
+    return {"files": len(results),
+            "audio_seconds": seconds,
+            "decoded_mb": decoded_mb,
+            "fingerprints": sum(r["fingerprints"] for r in results),
+            "stage_seconds": total,
+            "stage_seconds_per_mb": {stage: value / decoded_mb if decoded_mb else 0.0 for stage, value in total.items()},
+            "stage_seconds_per_audio_minute": {stage: value * 60 / seconds if seconds else 0.0 for stage, value in total.items()},
+            "total_seconds": wall,
+            "realtime_factor": seconds / wall if wall else 0.0}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="fingerprint ingest benchmark")
+    parser.add_argument("--corpus", default=os.path.join(tempfile.gettempdir(), "recsong_bench_corpus"), help="where the synthetic corpus is written")
+    parser.add_argument("--files", type=int, default=12)
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--db", default=None, help="sqlite file for the insert stage, default a fresh temp file")
+    parser.add_argument("--out", default=None, help="write the JSON results here")
+    parser.add_argument("--baseline", default=None, help="JSON results of an earlier run to compare with")
+    args = parser.parse_args(argv)
+
+    corpus = generateCorpus(args.corpus, args.files, args.seconds, args.seed)
+    db = args.db or os.path.join(tempfile.mkdtemp(), "bench.db")
+    storage = Storage.SQLiteBackend(db)
+    storage.createTables()
+
+    results = []
+    for filepath, kind in corpus:
+        result = ingestFile(storage, filepath)
+        if result is None:
+            print("read %s fail" % filepath)
+            continue
+        result["file"] = os.path.basename(filepath)
+        result["kind"] = kind
+        results.append(result)
+        print("%-16s %6.1f sec audio, %6d fingerprints, " % (result["file"], result["seconds"], result["fingerprints"])
+              + ", ".join("%s %.3f" % (stage, result["timing"][stage]) for stage in STAGES))
+
+    report = {"meta": {"commit": gitCommit(),
+                       "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                       "python": platform.python_version(),
+                       "numpy": np.__version__,
+                       "platform": platform.platform(),
+                       "seed": args.seed,
+                       "files": args.files,
+                       "seconds": args.seconds,
+                       "fpconfig": {name: value for name, value in vars(FPconfig).items() if not name.startswith("_")}},
+              "summary": summarize(results),
+              "files": results}
+    summary = report["summary"]
+    print("%d files, %.0f sec audio, %.1f MB decoded in %.2f sec (%.1fx realtime)" % (summary["files"], summary["audio_seconds"], summary["decoded_mb"], summary["total_seconds"], summary["realtime_factor"]))
+    print("sec per MB: " + ", ".join("%s %.4f" % item for item in summary["stage_seconds_per_mb"].items()))
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as fh:
+            baseline = json.load(fh)["summary"]["stage_seconds_per_mb"]
+        # 大于 1 表示比基准慢
+        print("vs baseline: " + ", ".join("%s %.2fx" % (stage, value / baseline[stage] if baseline.get(stage) else 0.0)
+                                          for stage, value in summary["stage_seconds_per_mb"].items()))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, indent=2, ensure_ascii=False, default=str)
+    return report
+
+if __name__ == "__main__":
+    main()
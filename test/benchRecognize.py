@@ -0,0 +1,265 @@
+"""识别准确率与延迟基准测试
+
+从参考音频(默认 song/)中随机截取 N 个片段, 叠加噪声、增益、均衡、时间偏移和 mp3 重新编码等劣化,
+统计 top-1 准确率、平均/p95 延迟、每个片段的数据库查询次数和查询的指纹数量;
+可以对 FPconfig 的参数做网格扫描, 每组参数重新导入参考音频, 所有参数使用相同的片段.
+sample/ 中是 song/ 中歌曲的片段, 一起作为参考时同一段音频对应多个正确答案, 会低估准确率, 因此默认只使用 song/;
+多个 --refs 目录之间不要有重叠的音频.
+
+    python test/benchRecognize.py --clips 50 --length 5 --out recognize.json
+    python test/benchRecognize.py --sweep fanout_factor=5,10,15 --sweep peak_neighborhood_size=10,20
+"""
+import os, sys, json, time, argparse, itertools, subprocess, tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+from recModule.Config import recConfig
+from recModule.Fingerprint import FPconfig
+from recModule import AudioDecoder, Fingerprint, Storage, Cache, Model
+from benchIngest import ROOT, writeWav, gitCommit
+import numpy as np
+
+DEGRADATIONS = ["noise", "gain", "eq", "offset", "mp3"]
+
+def loadReferences(dirs):
+    """解码参考音频
+
+    Returns
+    -------
+    List[Tuple[str, NDArray]]
+        (歌曲名, int16 单声道采样)
+    """
+    references = []
+    for folder in dirs:
+        for filepath in sorted(AudioDecoder.listDir(folder)):
+            fs, channels = AudioDecoder.read(filepath, "mono_mix")
+            if channels:
+                references.append((os.path.splitext(os.path.basename(filepath))[0], channels[0]))
+    return references
+
+def degrade(rng, samples, fs, degradations, snr):
+    """对 [-1, 1] 浮点采样依次施加劣化
+
+    noise 按 snr(dB) 叠加白噪声; gain 随机增益 -12~+6 dB; eq 对低、中、高三个频段随机增益 -6~+6 dB;
+    offset 丢弃开头不足一个 FFT 帧移的随机采样数, 使片段与参考音频的分帧错开
+    """
+    if "offset" in degradations:
+        hop = FPconfig.fft_window_size - int(FPconfig.fft_window_size * FPconfig.fft_overlap_ratio)
+        samples = samples[rng.integers(hop):]
+    if "eq" in degradations:
+        spectrum = np.fft.rfft(samples)
+        freqs = np.fft.rfftfreq(samples.size, 1 / fs)
+        gains = 10 ** (rng.uniform(-6, 6, 3) / 20)
+        spectrum *= np.where(freqs < 300, gains[0], np.where(freqs < 4000, gains[1], gains[2]))
+        samples = np.fft.irfft(spectrum, samples.size)
+    if "noise" in degradations:
+        power = np.mean(samples ** 2)
+        samples = samples + rng.standard_normal(samples.size) * np.sqrt(power / 10 ** (snr / 10))
+    if "gain" in degradations:
+        samples = samples * 10 ** (rng.uniform(-12, 6) / 20)
+    return samples
+
+def makeClips(rng, references, clips, length, degradations, snr, bitrate, workdir, fs=recConfig.audio_frame_rate):
+    """截取并劣化片段, 写为 wav(或 mp3 重新编码后的 mp3)文件
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        每个片段的文件路径、参考歌曲名和在参考音频中的起始位置(秒)
+    """
+    os.makedirs(workdir, exist_ok=True)
+    size = int(length * fs)
+    result = []
+    for i in range(clips):
+        name, samples = references[rng.integers(len(references))]
+        st = int(rng.integers(max(samples.size - size, 1)))
+        clip = degrade(rng, samples[st:st + size].astype(np.float64) / 32768, fs, degradations, snr)
+        path = os.path.join(workdir, "clip_%04d.wav" % i)
+        writeWav(path, clip, fs)
+        if "mp3" in degradations:
+            mp3 = path[:-4] + ".mp3"
+            subprocess.run(["ffmpeg", "-loglevel", "quiet", "-nostdin", "-y", "-i", path, "-b:a", bitrate, mp3], check=True)
+            os.remove(path)
+            path = mp3
+        result.append({"file": path, "name": name, "start": st / fs})
+    return result
+
+def fingerprint(channels, fs):
+    """按当前 FPconfig 生成指纹
+
+    Fingerprint 中函数的默认参数在导入时已经确定, 扫描的参数需要显式传入
+
+    Returns
+    -------
+    NDArray
+        以 ("hash", "offset") 为字段的结构化数组
+    """
+    hashes, offsets = [], []
+    for channel in channels:
+        arr = Fingerprint.getSpecgramArr(channel, fs, FPconfig.fft_window_size, None, int(FPconfig.fft_window_size * FPconfig.fft_overlap_ratio))
+        peaks = Fingerprint.getConstellationMap(arr, min_peak_amp=FPconfig.minimun_peak_amplitude, max_peaks=FPconfig.max_peaks_per_frame)
+        h, o = Fingerprint.getFBHashArray(peaks, FPconfig.fanout_factor)
+        hashes.append(h)
+        offsets.append(o)
+    return Fingerprint.uniqueFingerprints(np.concatenate(hashes), np.concatenate(offsets))
+
+class CountingStorage(object):
+    """包装存储后端, 统计 lookupFingerprints 的调用次数(即数据库查询次数)"""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.queries = 0
+
+    def lookupFingerprints(self, hashes):
+        self.queries += 1
+        return self.storage.lookupFingerprints(hashes)
+
+    def queryMatches(self, hashes, offsets, batch_size=recConfig.query_batch_size):
+        # 使用基类的分批逻辑, 每批通过本对象的 lookupFingerprints 查询
+        return Storage.StorageBackend.queryMatches(self, hashes, offsets, batch_size)
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+def ingest(references, db):
+    """用当前 FPconfig 将参考音频导入新的 SQLite 数据库"""
+    storage = Storage.SQLiteBackend(db)
+    storage.createTables()
+    for name, samples in references:
+        song_id = storage.addSong(name, name)
+        storage.insertFingerprints(song_id, fingerprint([samples], recConfig.audio_frame_rate))
+        storage.setFingerprinted(song_id)
+    return storage
+
+def evaluate(clips, storage, early_exit):
+    """识别全部片段
+
+    Returns
+    -------
+    Tuple[Dict[str, Any], List[Dict[str, Any]]]
+        汇总结果和每个片段的结果
+    """
+    counting = CountingStorage(storage)
+    Storage.setStorage(counting)
+    Cache.getCache().clear()
+    rows = []
+    for clip in clips:
+        counting.queries = 0
+        t = time.perf_counter()
+        audio = Model.Audio(clip["file"], None, None)
+        audio.read(recConfig.channel_strategy)
+        audio.fingerprints = fingerprint(audio.channels, audio.fs)
+        t1 = time.perf_counter()
+        result = audio.recognizeEarly() if early_exit else audio.recognize_s()
+        t2 = time.perf_counter()
+        position = result["position"] if result["count"] else None
+        rows.append({"file": os.path.basename(clip["file"]),
+                     "expected": clip["name"],
+                     "predicted": result["name"],
+                     "correct": result["name"] == clip["name"],
+                     # 识别正确时定位误差(秒)
+                     "position_error": abs(position - clip["start"]) if result["name"] == clip["name"] else None,
+                     "count": result["count"],
+                     "confidence": result["confidence"],
+                     "hashes": result["hashes"],
+                     "queries": counting.queries,
+                     "fingerprint_seconds": t1 - t,
+                     "match_seconds": t2 - t1,
+                     "latency": t2 - t})
+    latency = np.array([row["latency"] for row in rows])
+    errors = [row["position_error"] for row in rows if row["position_error"] is not None]
+    summary = {"clips": len(rows),
+               "top1_accuracy": float(np.mean([row["correct"] for row in rows])) if rows else 0.0,
+               "latency_mean": float(latency.mean()) if rows else 0.0,
+               "latency_p95": float(np.percentile(latency, 95)) if rows else 0.0,
+               "match_mean": float(np.mean([row["match_seconds"] for row in rows])) if rows else 0.0,
+               "queries_per_clip": float(np.mean([row["queries"] for row in rows])) if rows else 0.0,
+               "hashes_per_clip": float(np.mean([row["hashes"] for row in rows])) if rows else 0.0,
+               "position_error_median": float(np.median(errors)) if errors else None}
+    return summary, rows
+
+def parseSweep(items):
+    """将 ["fanout_factor=5,10"] 解析为参数名到取值列表的映射"""
+    sweep = {}
+    for item in items:
+        name, _, values = item.partition("=")
+        if not hasattr(FPconfig, name):
+            raise ValueError("FPconfig has no parameter %s" % name)
+        cast = type(getattr(FPconfig, name))
+        sweep[name] = [cast(value) for value in values.split(",")]
+    return sweep
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="recognition accuracy vs latency benchmark")
+    parser.add_argument("--refs", action="append", default=None, help="reference audio directory, default song/; directories must not share audio")
+    parser.add_argument("--clips", type=int, default=30)
+    parser.add_argument("--length", type=float, default=5, help="clip length in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--degrade", default=",".join(DEGRADATIONS), help="comma separated subset of %s, empty for clean clips" % ",".join(DEGRADATIONS))
+    parser.add_argument("--snr", type=float, default=10, help="noise SNR in dB")
+    parser.add_argument("--bitrate", default="64k", help="mp3 re-encode bitrate")
+    parser.add_argument("--early-exit", action="store_true", help="use recognizeEarly instead of recognize_s")
+    parser.add_argument("--sweep", action="append", default=[], help="FPconfig grid, e.g. fanout_factor=5,10,15 (repeatable)")
+    parser.add_argument("--workdir", default=None, help="where clips and databases are written, default a temp dir")
+    parser.add_argument("--out", default=None, help="write the JSON results here")
+    args = parser.parse_args(argv)
+
+    # 统计真实的数据库查询次数, 关闭缓存
+    recConfig.hash_cache_size = 0
+    recConfig.fingerprint_cache_dir = None
+    recConfig.index_path = None
+    degradations = [item for item in args.degrade.split(",") if item]
+    for item in degradations:
+        if item not in DEGRADATIONS:
+            raise ValueError("unknown degradation %s" % item)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="recsong_bench_")
+    references = loadReferences(args.refs or [os.path.join(ROOT, "song")])
+    if not references:
+        print("no reference audio found")
+        return None
+    rng = np.random.default_rng(args.seed)
+    clips = makeClips(rng, references, args.clips, args.length, degradations, args.snr, args.bitrate, os.path.join(workdir, "clips"))
+    print("%d references, %d clips of %.1f sec, degradations: %s" % (len(references), len(clips), args.length, ",".join(degradations) or "none"))
+
+    sweep = parseSweep(args.sweep)
+    names = list(sweep.keys())
+    defaults = {name: getattr(FPconfig, name) for name in names}
+    runs = []
+    try:
+        for values in itertools.product(*[sweep[name] for name in names]):
+            params = dict(zip(names, values))
+            for name, value in params.items():
+                setattr(FPconfig, name, value)
+            db = os.path.join(workdir, "bench_%d.db" % len(runs))
+            t = time.perf_counter()
+            storage = ingest(references, db)
+            ingest_seconds = time.perf_counter() - t
+            summary, rows = evaluate(clips, storage, args.early_exit)
+            summary["ingest_seconds"] = ingest_seconds
+            runs.append({"params": params, "summary": summary, "clips": rows})
+            print("%-50s top1 %.3f, latency mean %.3f p95 %.3f sec, %.1f queries, %.0f hashes per clip"
+                  % (json.dumps(params), summary["top1_accuracy"], summary["latency_mean"], summary["latency_p95"],
+                     summary["queries_per_clip"], summary["hashes_per_clip"]))
+    finally:
+        for name, value in defaults.items():
+            setattr(FPconfig, name, value)
+
+    report = {"meta": {"commit": gitCommit(),
+                       "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                       "seed": args.seed,
+                       "clips": args.clips,
+                       "length": args.length,
+                       "degradations": degradations,
+                       "snr": args.snr,
+                       "bitrate": args.bitrate,
+                       "early_exit": args.early_exit,
+                       "references": [name for name, _ in references],
+                       "fpconfig": {name: value for name, value in vars(FPconfig).items() if not name.startswith("_")}},
+              "runs": runs}
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, indent=2, ensure_ascii=False, default=str)
+    return report
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""getFBHashArray 与原双重循环实现的一致性测试
+
+在随机峰值集合上比较向量化实现和原来逐个组合生成哈希的双重循环, 三种哈希模式下
+生成的 (hash, offset) 序列必须完全相同(包括顺序)
+
+    python -m pytest test/testFBHashArray.py
+    python test/testFBHashArray.py
+"""
+import os, sys, hashlib
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+from recModule.Fingerprint import FPconfig
+from recModule import Fingerprint
+import numpy as np
+
+HASH_MODES = ["sha256", "int32", "int64"]
+
+def loopHashes(peaks, fanout_factor, hash_mode):
+    """原 getFBHashGenerator 的双重循环, 整数模式下用 packHash 代替 sha256"""
+    peaks = [tuple(peak) for peak in peaks]
+    if FPconfig.peak_sort:
+        peaks.sort(key=lambda x: x[0])
+    result = []
+    for i in range(len(peaks) - fanout_factor):
+        for j in range(fanout_factor):
+            t1 = peaks[i][0]
+            t2 = peaks[i + j][0]
+            freq1 = peaks[i][1]
+            freq2 = peaks[i + j][1]
+            t_delta = t2 - t1
+            if t_delta >= FPconfig.time_constraint_condition[0] and t_delta <= FPconfig.time_constraint_condition[1]:
+                if hash_mode == "sha256":
+                    h = hashlib.sha256(("%s_%s_%s" % (str(freq1), str(freq2), str(t_delta))).encode()).hexdigest()[0:64 - FPconfig.fingerprint_cutoff]
+                else:
+                    h = int(Fingerprint.packHash(freq1, freq2, t_delta, hash_mode))
+                result.append((h, t1))
+    return result
+
+def randomPeaks(rng, n, frames=600):
+    """随机峰值 (time, frequency), 时间有重复, 频率不超过 nfft // 2"""
+    times = rng.integers(0, frames, n)
+    freqs = rng.integers(0, FPconfig.fft_window_size // 2 + 1, n)
+    return np.stack([times, freqs], axis=1)
+
+def checkMode(hash_mode, seeds=range(10), fanouts=(1, 5, 15)):
+    old_mode = FPconfig.hash_mode
+    FPconfig.hash_mode = hash_mode
+    try:
+        for seed in seeds:
+            rng = np.random.default_rng(seed)
+            for fanout_factor in fanouts:
+                # 包括峰值数量不超过 fanout_factor 的情况
+                for n in (0, fanout_factor, int(rng.integers(50, 800))):
+                    peaks = randomPeaks(rng, n)
+                    hashes, offsets = Fingerprint.getFBHashArray(peaks, fanout_factor)
+                    expected = loopHashes(peaks, fanout_factor, hash_mode)
+                    assert list(zip(hashes.tolist(), offsets.tolist())) == expected, (hash_mode, seed, fanout_factor, n)
+                    assert list(Fingerprint.getFBHashGenerator(peaks, fanout_factor)) == expected
+    finally:
+        FPconfig.hash_mode = old_mode
+
+def testSha256():
+    checkMode("sha256")
+
+def testInt32():
+    checkMode("int32")
+
+def testInt64():
+    checkMode("int64")
+
+def testCutoff():
+    old_cutoff = FPconfig.fingerprint_cutoff
+    FPconfig.fingerprint_cutoff = 24
+    try:
+        checkMode("sha256", seeds=range(3))
+    finally:
+        FPconfig.fingerprint_cutoff = old_cutoff
+
+if __name__ == "__main__":
+    for mode in HASH_MODES:
+        checkMode(mode)
+        print("%s ok" % mode)